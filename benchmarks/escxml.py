@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+
+Compare escXML() with the original character by character
+implementation over long rendered posts.
+"""
+
+import os
+import sys
+import types
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kaku_events import escXML
+
+
+def escXMLReference(text, escape_quotes=False):
+    if isinstance(text, types.UnicodeType):
+        s = list(text)
+    else:
+        if isinstance(text, types.IntType):
+            s = str(text)
+        else:
+            s = text
+        s = list(unicode(s, 'utf-8', 'ignore'))
+
+    cc      = 0
+    matches = ('&', '<', '"', '>')
+
+    for c in s:
+        if c in matches:
+            if c == '&':
+                s[cc] = u'&amp;'
+            elif c == '<':
+                s[cc] = u'&lt;'
+            elif c == '>':
+                s[cc] = u'&gt;'
+            elif escape_quotes:
+                s[cc] = u'&quot;'
+        cc += 1
+    return ''.join(s)
+
+paragraph = (u'<p>This is a paragraph with <a href="https://example.com/a?b=1&c=2">a link</a>, '
+             u'some <em>emphasis</em>, <strong>bold text</strong> and a few café accents '
+             u'so that the text looks like a typical rendered post.</p>\n')
+codeBlock = (u'<div class="codehilite"><pre><code>if (a &lt; b &amp;&amp; c &gt; d) {\n'
+             u'    printf("%s\\n", "quoted &amp; escaped");\n}\n</code></pre></div>\n')
+
+posts = { 'short post (2KB)':  paragraph * 8,
+          'long post (40KB)':  (paragraph * 10 + codeBlock * 4) * 20,
+          'huge post (400KB)': (paragraph * 10 + codeBlock * 4) * 200,
+        }
+
+if __name__ == '__main__':
+    for name in sorted(posts):
+        html = posts[name]
+        for quotes in (False, True):
+            assert escXML(html, quotes) == escXMLReference(html, quotes)
+            assert escXML(html.encode('utf-8'), quotes) == escXMLReference(html.encode('utf-8'), quotes)
+        n         = max(1, 200000 // len(html))
+        reference = min(timeit.repeat(lambda: escXMLReference(html), number=n, repeat=3)) / n
+        current   = min(timeit.repeat(lambda: escXML(html), number=n, repeat=3)) / n
+        print('%-18s reference %9.3f ms  escXML %7.3f ms  speedup %6.1fx' % (name, reference * 1000,
+                                                                              current * 1000,
+                                                                              reference / current))
@@ -8,12 +8,12 @@ import jinja2
 import logging
 import logging.handlers
 
-from flask import Flask
-from flask_redis import FlaskRedis
-from redis import StrictRedis
+from flask import Flask, request
 
 from kaku.controllers.main import main
 from kaku.controllers.auth import auth
+from kaku.store import KakuRedis
+from kaku.tokens import RevokedTokens
 from kaku.extensions import (
     debug_toolbar,
     cache
@@ -57,7 +57,21 @@ def create_app(object_name):
     # initialize the debug tool bar
     debug_toolbar.init_app(app)
 
-    app.dbRedis = FlaskRedis.from_custom_provider(StrictRedis, app)
+    if app.config['REDIS_MAX_CONNECTIONS'] is None:
+        app.dbRedis = KakuRedis.from_url(app.config['REDIS_URL'], keyBase=app.config['KEY_BASE'])
+    else:
+        app.dbRedis = KakuRedis.from_url(app.config['REDIS_URL'], keyBase=app.config['KEY_BASE'],
+                                         max_connections=app.config['REDIS_MAX_CONNECTIONS'])
+    app.revokedTokens = RevokedTokens(app.dbRedis, app.config['TOKEN_REVOCATION_TTL'])
+
+    @app.before_request
+    def resetRoundTrips():
+        app.dbRedis.resetRoundTrips()
+
+    @app.after_request
+    def logRoundTrips(response):
+        app.logger.debug('[%s] %d redis round trips' % (request.path, app.dbRedis.roundTrips()))
+        return response
 
     # register our blueprints
     app.register_blueprint(main)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+
+A content addressed store for large JSON documents, such as the mf2
+data parsed from a Webmention source, so that events and mention
+records only need to carry the document's hash.
+
+Documents are stored zlib compressed under the SHA-256 of their
+canonical JSON, so a document seen again is not stored twice. Each
+document keeps the set of references to it, for example the mentions
+that use it, and is deleted when its last reference is released.
+"""
+
+import json
+import zlib
+import hashlib
+
+import redis
+
+
+def blobKey(db, digest):
+    return db.key('kaku-blob::%s' % digest)
+
+def refsKey(db, digest):
+    return db.key('kaku-blob-refs::%s' % digest)
+
+def putBlob(db, data, ref):
+    """Store a JSON document if it is not already stored and add ref
+    to its references.
+
+    Returns the digest used to retrieve it.
+    """
+    value  = json.dumps(data, sort_keys=True)
+    digest = hashlib.sha256(value).hexdigest()
+    pipe   = db.pipeline()
+    pipe.set(blobKey(db, digest), zlib.compress(value), nx=True)
+    pipe.sadd(refsKey(db, digest), ref)
+    pipe.execute()
+    return digest
+
+def getBlob(db, digest):
+    """Return the JSON document stored under digest or None.
+    """
+    value = db.get(blobKey(db, digest))
+    if value is None:
+        return None
+    return json.loads(zlib.decompress(value))
+
+def releaseBlob(db, digest, ref):
+    """Remove ref from the references of a document and delete the
+    document once it has no references left.
+
+    Returns True if the document was deleted.
+    """
+    if db.srem(refsKey(db, digest), ref) == 0:
+        return False
+    with db.pipeline() as pipe:
+        try:
+            pipe.watch(refsKey(db, digest))
+            if pipe.scard(refsKey(db, digest)) > 0:
+                return False
+            pipe.multi()
+            pipe.delete(blobKey(db, digest))
+            pipe.execute()
+            return True
+        except redis.WatchError:
+            return False
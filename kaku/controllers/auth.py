@@ -84,17 +84,21 @@ def handleLogin():
                                                    }),
                                   authURL.fragment).geturl()
                 if current_app.dbRedis is not None:
-                    key  = 'login-%s' % me
-                    data = current_app.dbRedis.hgetall(key)
+                    db   = current_app.dbRedis
+                    key  = db.key('login-%s' % me)
+                    data = db.hgetall(key)
+                    pipe = db.pipeline()
                     if data and 'token' in data:  # clear any existing auth data
-                        current_app.dbRedis.delete('token-%s' % data['token'])
-                        current_app.dbRedis.hdel(key, 'token')
-                    current_app.dbRedis.hset(key, 'auth_url',     ParseResult(authURL.scheme, authURL.netloc, authURL.path, '', '', '').geturl())
-                    current_app.dbRedis.hset(key, 'from_uri',     form.from_uri.data)
-                    current_app.dbRedis.hset(key, 'redirect_uri', form.redirect_uri.data)
-                    current_app.dbRedis.hset(key, 'client_id',    form.client_id.data)
-                    current_app.dbRedis.hset(key, 'scope',        scope)
-                    current_app.dbRedis.expire(key, current_app.config['AUTH_TIMEOUT'])  # expire in N minutes unless successful
+                        pipe.delete(db.key('token-%s' % data['token']))
+                        pipe.hdel(key, 'token')
+                    pipe.hmset(key, { 'auth_url':     ParseResult(authURL.scheme, authURL.netloc, authURL.path, '', '', '').geturl(),
+                                      'from_uri':     form.from_uri.data,
+                                      'redirect_uri': form.redirect_uri.data,
+                                      'client_id':    form.client_id.data,
+                                      'scope':        scope,
+                                    })
+                    pipe.expire(key, current_app.config['AUTH_TIMEOUT'])  # expire in N minutes unless successful
+                    pipe.execute()
                 current_app.logger.info('redirecting to [%s]' % url)
                 return redirect(url)
         else:
@@ -115,8 +119,9 @@ def handleLoginSuccess():
 
     if current_app.dbRedis is not None:
         current_app.logger.info('getting data to validate auth code')
-        key  = 'login-%s' % me
-        data = current_app.dbRedis.hgetall(key)
+        db   = current_app.dbRedis
+        key  = db.key('login-%s' % me)
+        data = db.hgetall(key)
         if data:
             current_app.logger.info('calling [%s] to validate code' % data['auth_url'])
             r = ninka.indieauth.validateAuthCode(code=code,
@@ -133,11 +138,13 @@ def handleLoginSuccess():
                 from_uri = data['from_uri']
                 token    = str(uuid.uuid4())
 
-                current_app.dbRedis.hset(key, 'code',  code)
-                current_app.dbRedis.hset(key, 'token', token)
-                current_app.dbRedis.expire(key, current_app.config['AUTH_TIMEOUT'])
-                current_app.dbRedis.set('token-%s' % token, key)
-                current_app.dbRedis.expire('token-%s' % code, current_app.config['AUTH_TIMEOUT'])
+                pipe = db.pipeline()
+                pipe.hmset(key, { 'code':  code,
+                                  'token': token,
+                                })
+                pipe.expire(key, current_app.config['AUTH_TIMEOUT'])
+                pipe.set(db.key('token-%s' % token), 'login-%s' % me, ex=current_app.config['AUTH_TIMEOUT'])
+                pipe.execute()
 
                 session['indieauth_token'] = token
                 session['indieauth_scope'] = scope
@@ -163,9 +170,10 @@ def handleAuth():
     if current_app.dbRedis is not None:
         token = request.args.get('token')
         if token is not None:
-            me = current_app.dbRedis.get('token-%s' % token)
+            db = current_app.dbRedis
+            me = db.get(db.key('token-%s' % token))
             if me:
-                data = current_app.dbRedis.hgetall(me)
+                data = db.hgetall(db.key(me))
                 if data and data['token'] == token:
                     result = True
     if result:
@@ -3,19 +3,19 @@
 :copyright: (c) 2016 by Mike Taylor
 :license: CC0 1.0 Universal, see LICENSE for more details.
 """
-import uuid
 import urllib
 
 import ninka
 import requests
 
-from flask import Blueprint, current_app, request, redirect, render_template, jsonify
+from flask import Blueprint, current_app, request, redirect, render_template, jsonify, url_for
 from flask_wtf import Form
 from wtforms import TextField, HiddenField
 from urlparse import ParseResult
-from kaku.tools import checkAccessToken, validURL, clearAuth
+from kaku.tools import checkAccessToken, clearAuth, tokenSecret
+from kaku.tokens import createToken, isSignedToken, verifyToken, revokeToken
 from kaku.micropub import micropub
-from kaku.mentions import mention
+from kaku.mentions import checkMentionURLs, resolveTarget, queueMention, getMentionStatus
 
 from bearlib.tools import baseDomain
 
@@ -40,27 +40,27 @@ def request_wants_json():
 def handleWebmention():
     current_app.logger.info('handleWebmention [%s]' % request.method)
     if request.method == 'POST':
-        valid  = False
         source = request.form.get('source')
         target = request.form.get('target')
         vouch  = request.form.get('vouch')
         current_app.logger.info('source: %s target: %s vouch %s' % (source, target, vouch))
-        if current_app.config['BASEROUTE'] in target:
-            valid = validURL(target)
-            current_app.logger.info('valid? %s' % valid)
-            if valid == requests.codes.ok:
-                valid, vouched = mention(source, target, vouch)
-                if valid:
-                    return ('Webmention created for %s' % target, 201, {'Location': target})
-                else:
-                    if current_app.config['VOUCH_REQUIRED'] and not vouched:
-                        return 'Vouch required for webmention', 449
-                    else:
-                        return 'Webmention is invalid', 400
-            else:
-                return 'Webmention target was not found', 400
-        else:
-            return 'Webmention target is not valid', 400
+        error = checkMentionURLs(source, target, current_app.config['BASEROUTE'])
+        if error is not None:
+            return 'Webmention %s' % error, 400
+        if resolveTarget(current_app.dbRedis, target, current_app.config['BASEROUTE'],
+                         current_app.config['SITE_CONTENT'], current_app.config['TARGET_CACHE_TTL']) != 200:
+            return 'Webmention target was not found', 400
+        mentionId = queueMention(current_app.dbRedis, current_app.config['SITE_EVENTS'], source, target, vouch,
+                                 current_app.config['VOUCH_REQUIRED'], current_app.config['WEBMENTION_STATUS_TTL'])
+        statusURL = url_for('main.handleWebmentionStatus', mentionId=mentionId, _external=True)
+        return ('Webmention accepted for verification, status is at %s' % statusURL, 202, {'Location': statusURL})
+
+@main.route('/webmention/<mentionId>', methods=['GET'])
+def handleWebmentionStatus(mentionId):
+    status = getMentionStatus(current_app.dbRedis, mentionId)
+    if status is None:
+        return 'Webmention not found', 404
+    return jsonify(status)
 
 @main.route('/micropub', methods=['GET', 'POST', 'PATCH', 'PUT', 'DELETE'])
 def handleMicroPub():
@@ -79,7 +79,7 @@ def handleMicroPub():
         if request.method == 'POST':
             domain   = baseDomain(me, includeScheme=False)
             idDomain = baseDomain(current_app.config['CLIENT_ID'], includeScheme=False)
-            if domain == idDomain and checkAccessToken(access_token):
+            if domain == idDomain:
                 properties = {}
                 for key in ('h', 'name', 'summary', 'content', 'published', 'updated',
                             'slug', 'location', 'syndication', 'syndicate-to',
@@ -139,6 +139,21 @@ def handleToken():
             return (urllib.urlencode(params), 200, {'Content-Type': 'application/x-www-form-urlencoded'})
 
     elif request.method == 'POST':
+        if request.form.get('action') == 'revoke':
+            token = request.form.get('token')
+            if isSignedToken(token):
+                claims = verifyToken(tokenSecret(), token)
+                if claims is not None:
+                    revokeToken(current_app.dbRedis, claims)
+            elif token:
+                db       = current_app.dbRedis
+                tokenKey = db.key('token-%s' % token)
+                key      = db.get(tokenKey)
+                if key:
+                    db.delete(db.key(key), tokenKey)
+            current_app.logger.info('token revoked')
+            return ('', 200, {})
+
         code         = request.form.get('code')
         me           = request.form.get('me')
         redirect_uri = request.form.get('redirect_uri')
@@ -158,15 +173,9 @@ def handleToken():
         if r['status'] == requests.codes.ok:
             current_app.logger.info('token request auth code verified')
             scope = r['response']['scope']
-            key   = 'app-%s-%s-%s' % (me, client_id, scope)
-            token = current_app.dbRedis.get(key)
-            if token is None:
-                token     = str(uuid.uuid4())
-                token_key = 'token-%s' % token
-                current_app.dbRedis.set(key, token)
-                current_app.dbRedis.set(token_key, key)
+            token = createToken(tokenSecret(), me, client_id, scope, current_app.config['TOKEN_LIFETIME'])
 
-            current_app.logger.info('  token generated for [%s] : [%s]' % (key, token))
+            current_app.logger.info('  token generated for [%s] [%s] [%s]' % (me, client_id, scope))
             params = { 'me': me,
                        'scope': scope,
                        'access_token': token
@@ -205,16 +214,17 @@ def handleAccessToken():
                                                    }),
                                   authURL.fragment).geturl()
 
-                key  = 'access-%s' % me
-                data = current_app.dbRedis.hgetall(key)
-                if data and 'token' in data:  # clear any existing auth data
-                    current_app.dbRedis.delete('token-%s' % data['token'])
-                    current_app.dbRedis.hdel(key, 'token')
-                current_app.dbRedis.hset(key, 'auth_url',     ParseResult(authURL.scheme, authURL.netloc, authURL.path, '', '', '').geturl())
-                current_app.dbRedis.hset(key, 'redirect_uri', form.redirect_uri.data)
-                current_app.dbRedis.hset(key, 'client_id',    form.client_id.data)
-                current_app.dbRedis.hset(key, 'scope',        form.scope.data)
-                current_app.dbRedis.expire(key, current_app.config['AUTH_TIMEOUT'])  # expire in N minutes unless successful
+                db   = current_app.dbRedis
+                key  = db.key('access-%s' % me)
+                pipe = db.pipeline()
+                pipe.hdel(key, 'token', 'code')  # clear any existing auth data
+                pipe.hmset(key, { 'auth_url':     ParseResult(authURL.scheme, authURL.netloc, authURL.path, '', '', '').geturl(),
+                                  'redirect_uri': form.redirect_uri.data,
+                                  'client_id':    form.client_id.data,
+                                  'scope':        form.scope.data,
+                                })
+                pipe.expire(key, current_app.config['AUTH_TIMEOUT'])  # expire in N minutes unless successful
+                pipe.execute()
                 current_app.logger.info('redirecting to [%s]' % url)
                 return redirect(url)
         else:
@@ -230,8 +240,9 @@ def handleAccessToken():
             return render_template('mptoken.jinja', **templateContext)
         else:
             current_app.logger.info('getting data to validate auth code')
-            key  = 'access-%s' % me
-            data = current_app.dbRedis.hgetall(key)
+            db   = current_app.dbRedis
+            key  = db.key('access-%s' % me)
+            data = db.hgetall(key)
             if data:
                 current_app.logger.info('calling [%s] to validate code' % data['auth_url'])
                 r = ninka.indieauth.validateAuthCode(code=code,
@@ -241,13 +252,9 @@ def handleAccessToken():
                 current_app.logger.info('validateAuthCode returned %s' % r['status'])
                 if r['status'] == requests.codes.ok:
                     current_app.logger.info('login code verified')
-                    token = str(uuid.uuid4())
+                    token = createToken(tokenSecret(), me, data['client_id'], data['scope'], current_app.config['TOKEN_LIFETIME'])
 
-                    current_app.dbRedis.hset(key, 'code',  code)
-                    current_app.dbRedis.hset(key, 'token', token)
-                    current_app.dbRedis.expire(key, current_app.config['AUTH_TIMEOUT'])
-                    current_app.dbRedis.set('token-%s' % token, key)
-                    current_app.dbRedis.expire('token-%s' % code, current_app.config['AUTH_TIMEOUT'])
+                    db.delete(key)
                     return 'Access Token: %s' % token, 200
                 else:
                     current_app.logger.info('login invalid')
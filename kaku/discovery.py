@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+
+Webmention endpoint discovery with a Redis backed cache shared by
+the Flask app and the kaku_events daemon.
+
+Results are cached by target URL for the lifetime given by the
+target's Cache-Control or Expires headers, limited to the configured
+TTL. Targets without an endpoint are cached as well, by URL only as
+other pages of the same host may have one. Host wide failures, a
+connection error or a 5xx response, are cached by host so repeat
+sends to a host that is down are skipped.
+"""
+
+import json
+import time
+import logging
+
+import ronkyuu
+import requests
+
+from urlparse import urlparse
+from email.utils import parsedate_tz, mktime_tz
+
+
+logger = logging.getLogger(__name__)
+
+def urlKey(db, url):
+    return db.key('kaku-discovery::url::%s' % url)
+
+def hostKey(db, url):
+    return db.key('kaku-discovery::host::%s' % urlparse(url).netloc)
+
+def cacheLifetime(headers, ttl):
+    """Determine how long a response may be cached from its headers.
+
+    Returns the lifetime in seconds limited to ttl, or 0 if the
+    response must not be cached.
+    """
+    result       = ttl
+    cacheControl = headers.get('cache-control', '').lower()
+    for item in cacheControl.split(','):
+        item = item.strip()
+        if item in ('no-store', 'no-cache', 'private'):
+            return 0
+        if item.startswith('max-age='):
+            try:
+                return max(0, min(ttl, int(item[8:])))
+            except ValueError:
+                pass
+    expires = headers.get('expires')
+    if expires is not None:
+        expiresDate = parsedate_tz(expires)
+        if expiresDate is None:
+            result = 0
+        else:
+            result = max(0, min(ttl, int(mktime_tz(expiresDate) - time.time())))
+    return result
+
+def discoverEndpoint(db, url, ttl=86400, negativeTTL=3600, timeout=10):
+    """Discover the Webmention endpoint for url using the shared cache.
+
+    ttl:         maximum seconds a discovered endpoint is cached
+    negativeTTL: maximum seconds a "no endpoint" result or a host
+                 failure is cached
+    timeout:     seconds to wait for the target to respond
+
+    Returns a tuple of status, endpoint URL and a list of debug strings.
+    """
+    cached, hostCached = db.mget(urlKey(db, url), hostKey(db, url))
+    if cached is not None:
+        data = json.loads(cached)
+        return data['status'], data['url'], ['cached discovery result for %s' % url]
+    if hostCached is not None:
+        data = json.loads(hostCached)
+        return data['status'], None, ['cached failure result for host of %s' % url]
+
+    try:
+        r = requests.get(url, verify=False, timeout=timeout)
+    except requests.exceptions.RequestException:
+        logger.exception('exception during endpoint discovery for [%s]' % url)
+        db.set(hostKey(db, url), json.dumps({ 'status': 500, 'url': None }), ex=negativeTTL)
+        return 500, None, ['exception during GET request']
+
+    wmStatus, wmUrl, debug = ronkyuu.discoverEndpoint(url, test_urls=False, request=r, debug=True)
+    data = json.dumps({ 'status': wmStatus,
+                        'url':    wmUrl
+                      })
+    if wmStatus >= 500:
+        db.set(hostKey(db, url), data, ex=negativeTTL)
+    elif wmStatus == requests.codes.ok or 400 <= wmStatus < 500:
+        if wmUrl is None:
+            lifetime = cacheLifetime(r.headers, negativeTTL)
+        else:
+            lifetime = cacheLifetime(r.headers, ttl)
+        if lifetime > 0:
+            db.set(urlKey(db, url), data, ex=lifetime)
+    return wmStatus, wmUrl, debug
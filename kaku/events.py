@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+
+Kaku events are stored as a JSON payload under their own key and that
+key is then pushed onto a Redis list which acts as the event queue.
+Both are sent in a single MULTI/EXEC transaction so a consumer never
+sees an event key without its payload, and a list of events is
+published with one MSET and one LPUSH.
+
+Consumers claim an event by atomically moving its key from the queue
+to their own processing list and acknowledge it by removing the key
+from that list once it has been handled. Every consumer keeps a
+heartbeat key alive so that events held by a consumer that has
+stopped can be reclaimed and returned to the queue.
+
+Payloads larger than the compression threshold are stored zlib
+compressed. Handled events expire after a while. A failed event is
+retried after a delay that doubles with each attempt and events that
+keep failing are moved to a capped dead-letter list, from where they
+can be replayed once the cause has been fixed.
+
+All keys, including the queue, are namespaced with db.key().
+"""
+
+import json
+import time
+import uuid
+import zlib
+
+
+compressedPrefix = 'zlib:'
+
+
+def createEvent(eventType, eventAction, eventData):
+    """Generate the key and payload for a Kaku event.
+    """
+    key  = 'kaku-event::%s::%s::%s' % (eventType, eventAction, str(uuid.uuid4()))
+    data = { 'type':   eventType,
+             'action': eventAction,
+             'data':   eventData,
+             'key':    key
+           }
+    return key, data
+
+def encodePayload(data, compress=1024):
+    """Return the stored form of an event payload, compressed if the
+    JSON is longer than compress bytes. A compress of None disables compression.
+    """
+    result = json.dumps(data)
+    if compress is not None and len(result) > compress:
+        result = compressedPrefix + zlib.compress(result)
+    return result
+
+def decodePayload(value):
+    """Return the event payload from its stored form.
+    """
+    if value.startswith(compressedPrefix):
+        value = zlib.decompress(value[len(compressedPrefix):])
+    return json.loads(value)
+
+def loadEvent(db, eventKey):
+    """Return the payload of an event or None if it has expired.
+    """
+    value = db.get(eventKey)
+    if value is None:
+        return None
+    return decodePayload(value)
+
+def addEvents(pipe, queue, events, compress=1024):
+    """Add the commands that store and queue a list of events to a pipeline.
+
+    events:   list of (eventType, eventAction, eventData) tuples
+    compress: payloads longer than this are compressed, None disables compression
+
+    The events are queued in the order given. Returns the event keys.
+    """
+    keys     = []
+    payloads = {}
+    for eventType, eventAction, eventData in events:
+        key, data     = createEvent(eventType, eventAction, eventData)
+        key           = pipe.key(key)
+        data['key']   = key
+        payloads[key] = encodePayload(data, compress)
+        keys.append(key)
+    if len(keys) > 0:
+        pipe.mset(payloads)
+        pipe.lpush(pipe.key(queue), *keys)
+    return keys
+
+def addEvent(pipe, queue, eventType, eventAction, eventData, compress=1024):
+    """Add the commands that store and queue an event to a pipeline.
+
+    Returns the event key.
+    """
+    return addEvents(pipe, queue, [(eventType, eventAction, eventData)], compress)[0]
+
+def publishEvent(db, queue, eventType, eventAction, eventData, compress=1024):
+    """Store the event payload and add the event key to the queue
+    in one atomic round trip.
+    """
+    pipe = db.pipeline()
+    key  = addEvent(pipe, queue, eventType, eventAction, eventData, compress)
+    pipe.execute()
+    return key
+
+def publishEvents(db, queue, events, pipe=None, compress=1024):
+    """Publish a list of events in one atomic round trip.
+
+    events: list of (eventType, eventAction, eventData) tuples
+    pipe:   an optional transaction pipeline holding other commands
+            that are to be sent with the events
+
+    Returns the event keys.
+    """
+    if pipe is None:
+        pipe = db.pipeline()
+    keys = addEvents(pipe, queue, events, compress)
+    pipe.execute()
+    return keys
+
+def processingKey(db, queue, consumer):
+    return db.key('%s::processing::%s' % (queue, consumer))
+
+def heartbeatKey(db, queue, consumer):
+    return db.key('%s::consumer::%s' % (queue, consumer))
+
+def consumersKey(db, queue):
+    return db.key('%s::consumers' % queue)
+
+def attemptsKey(db, queue):
+    return db.key('%s::attempts' % queue)
+
+def retryKey(db, queue):
+    return db.key('%s::retry' % queue)
+
+def deadKey(db, queue):
+    return db.key('%s::dead' % queue)
+
+def registerConsumer(db, queue, consumer, timeout):
+    """Register the consumer and refresh its heartbeat.
+
+    The consumer is considered to have stopped if the heartbeat
+    is not refreshed within timeout seconds.
+    """
+    pipe = db.pipeline()
+    pipe.sadd(consumersKey(db, queue), consumer)
+    pipe.set(heartbeatKey(db, queue, consumer), 1, ex=timeout)
+    pipe.execute()
+
+def claimEvent(db, queue, consumer, timeout=5):
+    """Wait up to timeout seconds for an event and claim it for the consumer.
+
+    A timeout of 0 does not wait and only claims an event already queued.
+    Returns the event key or None if no event arrived.
+    """
+    if timeout == 0:
+        return db.rpoplpush(db.key(queue), processingKey(db, queue, consumer))
+    else:
+        return db.brpoplpush(db.key(queue), processingKey(db, queue, consumer), timeout)
+
+def ackEvent(db, queue, consumer, eventKey):
+    """Acknowledge that the consumer has finished with the event.
+    """
+    db.lrem(processingKey(db, queue, consumer), 1, eventKey)
+
+def reclaimEvents(db, queue, consumer=None):
+    """Return any events held by stopped consumers to the queue.
+
+    Any events still held by the given consumer are also returned, this
+    recovers events claimed by a previous run that used the same name.
+    Returns the number of events reclaimed.
+    """
+    result = 0
+    for name in db.smembers(consumersKey(db, queue)):
+        if name == consumer or not db.exists(heartbeatKey(db, queue, name)):
+            while db.rpoplpush(processingKey(db, queue, name), db.key(queue)) is not None:
+                result += 1
+            if name != consumer:
+                db.srem(consumersKey(db, queue), name)
+    return result
+
+def completeEvent(db, queue, eventKey, ttl=86400):
+    """Keep the payload of a handled event for ttl seconds.
+    """
+    pipe = db.pipeline()
+    pipe.expire(eventKey, ttl)
+    pipe.hdel(attemptsKey(db, queue), eventKey)
+    pipe.execute()
+
+def failEvent(db, queue, eventKey, retries=3, ttl=604800, deadMax=1000, delay=60):
+    """Schedule a failed event to be retried, or move it to the dead-letter
+    list once it has failed retries times.
+
+    The first retry is after delay seconds and the delay doubles with each
+    attempt. Dead events keep their payload for ttl seconds and only the
+    deadMax most recent are kept. Returns True if the event will be retried.
+    """
+    attempts = db.hincrby(attemptsKey(db, queue), eventKey, 1)
+    pipe     = db.pipeline()
+    if attempts < retries:
+        pipe.zadd(retryKey(db, queue), { eventKey: time.time() + delay * 2 ** (attempts - 1) })
+    else:
+        pipe.hdel(attemptsKey(db, queue), eventKey)
+        pipe.expire(eventKey, ttl)
+        pipe.lpush(deadKey(db, queue), eventKey)
+        pipe.ltrim(deadKey(db, queue), 0, deadMax - 1)
+    pipe.execute()
+    return attempts < retries
+
+def retryEvents(db, queue):
+    """Return any failed events that are due to be retried to the queue.
+
+    Returns the number of events returned.
+    """
+    result = 0
+    for eventKey in db.zrangebyscore(retryKey(db, queue), 0, time.time()):
+        if db.zrem(retryKey(db, queue), eventKey) > 0:
+            db.lpush(db.key(queue), eventKey)
+            result += 1
+    return result
+
+def replayDeadEvents(db, queue):
+    """Return every event in the dead-letter list to the queue.
+
+    The payloads of the events are kept until they have been handled
+    again. Events whose payload has already expired are removed from the
+    dead-letter list without being queued.
+
+    Returns the number of events replayed and a list of the expired event keys.
+    """
+    replayed = 0
+    expired  = []
+    eventKey = db.rpoplpush(deadKey(db, queue), db.key(queue))
+    while eventKey is not None:
+        db.persist(eventKey)
+        if db.exists(eventKey):
+            replayed += 1
+        else:
+            db.lrem(db.key(queue), 1, eventKey)
+            expired.append(eventKey)
+        eventKey = db.rpoplpush(deadKey(db, queue), db.key(queue))
+    return replayed, expired
@@ -2,23 +2,167 @@
 """
 :copyright: (c) 2016 by Mike Taylor
 :license: CC0 1.0 Universal, see LICENSE for more details.
+
+Incoming Webmentions are accepted by the Flask app after only syntactic
+checks and queued as a mention verify event. The kaku_events workers
+then fetch the source, check that it references the target, check any
+vouch and parse the source's mf2 data.
+
+The progress of each Webmention is kept in Redis under its id so the
+sender can follow it using the status URL returned by the endpoint.
+
+Webmention targets are resolved against the content tree, without any
+requests to our own site, and the result is cached in Redis until the
+post is generated again.
+
+The mf2 data parsed from a source is kept in the blob store when the
+mention is saved and the mention only carries its digest along with
+the fields needed to display it, the author's h-card, dates, name and
+a content summary.
 """
 
 import os
 import json
+import uuid
+import logging
 import datetime
 
 import pytz
 import ninka
 import ronkyuu
 
-from flask import current_app
+from urlparse import urlparse
 from mf2py.parser import Parser
 
-from kaku.tools import kakuEvent, extractHCard
+from kaku.tools import extractHCard
+from kaku.blobs import putBlob
+from kaku.events import addEvent
+from kaku.discovery import discoverEndpoint
+
+
+logger = logging.getLogger(__name__)
+
+def statusKey(db, mentionId):
+    return db.key('kaku-webmention::%s' % mentionId)
+
+def setMentionStatus(db, mentionId, status, detail, ttl, data=None):
+    """Record the status of a Webmention.
+
+    status: queued, accepted, deleted, rejected or error
+    detail: a human readable description of the status
+    """
+    result = { 'status': status,
+               'detail': detail,
+             }
+    if data is not None:
+        result['source'] = data['sourceURL']
+        result['target'] = data['targetURL']
+    else:
+        current = getMentionStatus(db, mentionId)
+        if current is not None:
+            result['source'] = current.get('source')
+            result['target'] = current.get('target')
+    db.set(statusKey(db, mentionId), json.dumps(result), ex=ttl)
+
+def getMentionStatus(db, mentionId):
+    """Return the status dict of a Webmention or None if it is not known.
+    """
+    value = db.get(statusKey(db, mentionId))
+    if value is None:
+        return None
+    return json.loads(value)
+
+def targetKey(db, route):
+    return db.key('kaku-target::%s' % route)
+
+def targetRoute(targetURL, baseRoute):
+    """Return the route of the post a target URL refers to, the URL path
+    below baseRoute without any .html extension.
+    """
+    targetPath = urlparse(targetURL.strip()).path
+    if targetPath.lower().endswith('.html'):
+        targetPath = targetPath[:-5]
+    if targetPath.startswith(baseRoute):
+        targetPath = targetPath[len(baseRoute):]
+    return targetPath.lstrip('/')
+
+def resolveTarget(db, targetURL, baseRoute, contentPath, ttl=3600, missingTTL=60):
+    """Determine if a Webmention target is one of our posts.
 
+    Returns 200 if the post exists, 410 if it has been deleted
+    and 404 if it does not exist.
 
-def processVouch(sourceURL, targetURL, vouchDomain):
+    As targets are given by the sender, a 404 is only cached for
+    missingTTL seconds and targets outside of baseRoute or the content
+    path are not cached at all.
+    """
+    if not urlparse(targetURL.strip()).path.startswith(baseRoute):
+        return 404
+    route       = targetRoute(targetURL, baseRoute)
+    contentPath = os.path.normpath(contentPath)
+    targetFile  = os.path.normpath(os.path.join(contentPath, route))
+    if not targetFile.startswith(contentPath + os.sep):
+        return 404
+
+    cached = db.get(targetKey(db, route))
+    if cached is not None:
+        return int(cached)
+    if not os.path.exists('%s.md' % targetFile):
+        result = 404
+    elif os.path.exists('%s.deleted' % targetFile):
+        result = 410
+    else:
+        result = 200
+    if result == 404:
+        db.set(targetKey(db, route), result, ex=min(ttl, missingTTL))
+    else:
+        db.set(targetKey(db, route), result, ex=ttl)
+    return result
+
+def invalidateTarget(db, route):
+    """Remove the cached resolution of a post's route.
+    """
+    db.delete(targetKey(db, route))
+
+def checkMentionURLs(sourceURL, targetURL, baseRoute):
+    """Make the syntactic checks of an incoming Webmention.
+
+    Returns None if the source and target are acceptable, otherwise
+    the reason they are not.
+    """
+    if not sourceURL or not targetURL:
+        return 'source and target are required'
+    source = urlparse(sourceURL)
+    target = urlparse(targetURL)
+    if source.scheme not in ('http', 'https') or not source.netloc:
+        return 'source is not a valid URL'
+    if target.scheme not in ('http', 'https') or not target.netloc:
+        return 'target is not a valid URL'
+    if sourceURL == targetURL:
+        return 'source and target are the same'
+    if baseRoute not in targetURL:
+        return 'target is not valid'
+    return None
+
+def queueMention(db, queue, sourceURL, targetURL, vouchDomain, vouchRequired, ttl):
+    """Queue a Webmention for verification by the event workers.
+
+    Returns the id of the Webmention used for its status.
+    """
+    mentionId = str(uuid.uuid4())
+    data      = { 'id':            mentionId,
+                  'sourceURL':     sourceURL,
+                  'targetURL':     targetURL,
+                  'vouchDomain':   vouchDomain,
+                  'vouchRequired': vouchRequired,
+                }
+    pipe = db.pipeline()
+    setMentionStatus(pipe, mentionId, 'queued', 'waiting for verification', ttl, data)
+    addEvent(pipe, queue, 'mention', 'verify', data)
+    pipe.execute()
+    return mentionId
+
+def processVouch(db, sourceURL, targetURL, vouchDomain, contentPath, ttl=86400, negativeTTL=3600, timeout=10):
     """Determine if the vouch domain is valid.
 
     This implements a very simple method for determining if a vouch should
@@ -29,8 +173,8 @@ def processVouch(sourceURL, targetURL, vouchDomain):
     """
     result       = False
     vouchDomains = []
-    vouchFile    = os.path.join(current_app.config['SITE_CONTENT'], 'vouch_domains.txt')
-    if os.isfile(vouchFile):
+    vouchFile    = os.path.join(contentPath, 'vouch_domains.txt')
+    if os.path.isfile(vouchFile):
         with open(vouchFile, 'r') as h:
             for domain in h.readlines():
                 vouchDomains.append(domain.strip().lower())
@@ -40,7 +184,7 @@ def processVouch(sourceURL, targetURL, vouchDomain):
     if vouchDomain.lower() in vouchDomains:
         result = True
     else:
-        wmStatus, wmUrl = ronkyuu.discoverEndpoint(vouchDomain, test_urls=False)
+        wmStatus, wmUrl, debug = discoverEndpoint(db, vouchDomain, ttl, negativeTTL, timeout)
         if wmUrl is not None and wmStatus == 200:
             authEndpoints = ninka.indieauth.discoverAuthEndpoints(vouchDomain)
 
@@ -55,8 +199,60 @@ def processVouch(sourceURL, targetURL, vouchDomain):
                         h.write('\n%s' % vouchDomain)
     return result
 
-def mention(sourceURL, targetURL, vouchDomain=None):
-    """Process the incoming Webmention from the sourceURL.
+def firstValue(properties, name):
+    values = properties.get(name, [])
+    if len(values) == 0:
+        return None
+    return values[0]
+
+def mentionFields(mf2Data, summaryLength=280):
+    """Extract the fields used to display a mention from the source's mf2 data.
+
+    Returns a dict of hcard, published, updated, name and summary, the
+    summary is the entry's summary or the text of its content cut to
+    summaryLength characters.
+    """
+    result = { 'hcard':     extractHCard(mf2Data),
+               'published': None,
+               'updated':   None,
+               'name':      None,
+               'summary':   None,
+             }
+    for item in mf2Data.get('items', []):
+        if 'h-entry' in item.get('type', []):
+            properties          = item.get('properties', {})
+            result['published'] = firstValue(properties, 'published')
+            result['updated']   = firstValue(properties, 'updated')
+            result['name']      = firstValue(properties, 'name')
+            summary             = firstValue(properties, 'summary')
+            if summary is None:
+                summary = firstValue(properties, 'content')
+                if isinstance(summary, dict):
+                    summary = summary.get('value')
+            if isinstance(summary, basestring):
+                summary = u' '.join(summary.split())
+                if len(summary) > summaryLength:
+                    summary = u'%s\u2026' % summary[:summaryLength].rstrip()
+                result['summary'] = summary
+            break
+    return result
+
+def slimMention(db, mention, ref):
+    """Move the mf2 data of a mention into the blob store, ref is the
+    mention's reference to the stored document.
+
+    The mf2data item is replaced by its digest, mf2, and any display
+    fields the mention does not already have are extracted from it.
+    """
+    if 'mf2data' in mention:
+        mf2Data        = mention.pop('mf2data')
+        mention['mf2'] = putBlob(db, mf2Data, ref)
+        for key, value in mentionFields(mf2Data).items():
+            mention.setdefault(key, value)
+    return mention
+
+def verifyMention(db, sourceURL, targetURL, vouchDomain, vouchRequired, contentPath, ttl=86400, negativeTTL=3600, timeout=10):
+    """Verify an incoming Webmention from the sourceURL.
 
     To verify that the targetURL being referenced by the sourceURL
     is a valid reference we run findMentions() at it and scan the
@@ -65,59 +261,48 @@ def mention(sourceURL, targetURL, vouchDomain=None):
     This does the following checks:
       1. The sourceURL exists
       2. The sourceURL indeed does reference our targetURL
-      3. The sourceURL is a valid Vouch (if configured to check)
-      4. The sourceURL is active and not deleted, if deleted then remove
-         it from our list of mentions for targetURL
+      3. The sourceURL is a valid Vouch (if required)
+      4. The sourceURL is active and not deleted, if deleted then
+         the mention should be removed from the targetURL
+
+    Returns a tuple of status, detail and the mention data. The
+    status is accepted, deleted or rejected. The mention data holds the
+    source's mf2 data, as mf2data, along with the display fields
+    extracted from it.
     """
-    current_app.logger.info('handling Webmention from %s' % sourceURL)
-
-    try:
-        result   = False
-        vouched  = False
-        mentions = ronkyuu.findMentions(sourceURL)
-        current_app.logger.info('mentions %s' % mentions)
-
-        if mentions['status'] == 410:
-            data = { 'targetURL': targetURL,
-                     'sourceURL': sourceURL
-                   }
-            current_app.logger.info('mention removal event from [%s] of [%s]' % (targetURL, sourceURL))
-            kakuEvent('mention', 'deleted', data)
-        else:
-            for href in mentions['refs']:
-                if href != sourceURL and href == targetURL:
-                    current_app.logger.info('post at %s was referenced by %s' % (targetURL, sourceURL))
-                    if current_app.config['VOUCH_REQUIRED']:
-                        if vouchDomain is None:
-                            vouched = False
-                            result  = False
-                        else:
-                            vouched = processVouch(sourceURL, targetURL, vouchDomain)
-                            result  = vouched
-                    else:
-                        vouched = False
-                        result  = True
-
-                    if result:
-                        utcdate   = datetime.datetime.utcnow()
-                        tzLocal   = pytz.timezone('America/New_York')
-                        timestamp = tzLocal.localize(utcdate, is_dst=None)
-                        mf2Data   = Parser(doc=mentions['content']).to_dict()
-                        hcard     = extractHCard(mf2Data)
-                        data      = { 'sourceURL':   sourceURL,
-                                      'targetURL':   targetURL,
-                                      'vouchDomain': vouchDomain,
-                                      'vouched':     vouched,
-                                      'postDate':    timestamp.strftime('%Y-%m-%dT%H:%M:%S'),
-                                      'hcard':       hcard,
-                                      'mf2data':     mf2Data,
-                                    }
-                        current_app.logger.info('mention created for [%s] from [%s]' % (targetURL, sourceURL))
-                        current_app.logger.info(json.dumps(data, indent=2))
-                        kakuEvent('mention', 'create', data)
-
-        current_app.logger.info('mention() returning %s' % result)
-    except ValueError:
-        current_app.logger.exception('Exception raised during webmention processing')
-        result = False
-    return result, vouched
+    logger.info('verifying Webmention from %s' % sourceURL)
+    data     = { 'targetURL': targetURL,
+                 'sourceURL': sourceURL
+               }
+    mentions = ronkyuu.findMentions(sourceURL, timeout=timeout)
+
+    if mentions['status'] == 410:
+        return 'deleted', 'source has been deleted', data
+    if mentions['status'] != 200:
+        return 'rejected', 'source returned status %s' % mentions['status'], data
+
+    for href in mentions['refs']:
+        if href != sourceURL and href == targetURL:
+            logger.info('post at %s was referenced by %s' % (targetURL, sourceURL))
+            vouched = False
+            if vouchRequired:
+                if vouchDomain is None:
+                    return 'rejected', 'vouch required', data
+                vouched = processVouch(db, sourceURL, targetURL, vouchDomain, contentPath, ttl, negativeTTL, timeout)
+                if not vouched:
+                    return 'rejected', 'vouch is not valid', data
+
+            utcdate   = datetime.datetime.utcnow()
+            tzLocal   = pytz.timezone('America/New_York')
+            timestamp = tzLocal.localize(utcdate, is_dst=None)
+            mf2Data   = Parser(doc=mentions['content']).to_dict()
+            data      = { 'sourceURL':   sourceURL,
+                          'targetURL':   targetURL,
+                          'vouchDomain': vouchDomain,
+                          'vouched':     vouched,
+                          'postDate':    timestamp.strftime('%Y-%m-%dT%H:%M:%S'),
+                          'mf2data':     mf2Data,
+                        }
+            data.update(mentionFields(mf2Data))
+            return 'accepted', 'mention created', data
+    return 'rejected', 'source does not link to target', data
@@ -12,11 +12,15 @@ _cwd = os.path.dirname(os.path.abspath(__file__))
 class Config(object):
     SECRET_KEY     = "bar"
     REDIS_URL      = 'redis://127.0.0.1:6379/0'
+    REDIS_MAX_CONNECTIONS = None
     KEY_BASE       = ''
     CLIENT_ID      = 'https://bear.im'
     BASEURL        = 'http://127.0.0.1:5000'
     BASE_ROUTE     = '/'
     AUTH_TIMEOUT   = 300
+    TOKEN_SECRET   = None
+    TOKEN_LIFETIME = 31536000
+    TOKEN_REVOCATION_TTL = 5
     VOUCH_REQUIRED = False
     CACHE_TYPE     = "null"
     CACHE_NO_NULL_WARNING = True
@@ -26,6 +30,11 @@ class Config(object):
     SITE_TEMPLATES = None
     SITE_SYNDICATE = None
     SITE_EVENTS    = 'kaku-events'
+    EVENT_COMPRESS = 1024
+    DISCOVERY_TTL  = 86400
+    DISCOVERY_NEGATIVE_TTL = 3600
+    WEBMENTION_STATUS_TTL  = 604800
+    TARGET_CACHE_TTL       = 3600
     LOG_FILE       = os.path.join(_cwd, 'kaku.log')
 
 class ProdConfig(Config):
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+
+The Redis client shared by the Flask app and the kaku_events daemon.
+
+All keys are namespaced with the configured key base using key(), this
+is done by the functions that build keys so callers only use the plain
+key names. Each client has a connection pool that is shared by all of
+its threads, and the number of round trips made by each thread is
+counted so slow request and event flows can be found.
+"""
+
+import threading
+
+import redis
+
+from redis.client import Pipeline
+
+
+class RoundTrips(threading.local):
+    count = 0
+
+class KakuPipeline(Pipeline):
+    """A pipeline that shares the key base and round trip count of its client.
+
+    A pipeline is sent in a single round trip, as a MULTI/EXEC
+    transaction unless it was created with transaction=False.
+    """
+    def __init__(self, connection_pool, response_callbacks, transaction, shard_hint, keyBase, roundTrips):
+        super(KakuPipeline, self).__init__(connection_pool, response_callbacks, transaction, shard_hint)
+        self.keyBase     = keyBase
+        self.tripCounter = roundTrips
+
+    def key(self, name):
+        return '%s%s' % (self.keyBase, name)
+
+    def execute(self, raise_on_error=True):
+        if len(self.command_stack) > 0:
+            self.tripCounter.count += 1
+        return super(KakuPipeline, self).execute(raise_on_error)
+
+class KakuRedis(redis.StrictRedis):
+    """A StrictRedis client that namespaces keys and counts round trips.
+    """
+    def __init__(self, keyBase='', **kwargs):
+        super(KakuRedis, self).__init__(**kwargs)
+        self.keyBase     = keyBase
+        self.tripCounter = RoundTrips()
+
+    @classmethod
+    def from_url(cls, url, keyBase='', db=None, **kwargs):
+        """Create a client with its own connection pool for the Redis URL.
+
+        Any keyword arguments, for example max_connections, are passed to the pool.
+        """
+        return cls(keyBase=keyBase, connection_pool=redis.ConnectionPool.from_url(url, db=db, **kwargs))
+
+    def key(self, name):
+        """Return the key name namespaced with the key base.
+        """
+        return '%s%s' % (self.keyBase, name)
+
+    def execute_command(self, *args, **options):
+        self.tripCounter.count += 1
+        return super(KakuRedis, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return KakuPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint,
+                            self.keyBase, self.tripCounter)
+
+    def roundTrips(self):
+        """Return the number of round trips made by this thread since resetRoundTrips().
+        """
+        return self.tripCounter.count
+
+    def resetRoundTrips(self):
+        self.tripCounter.count = 0
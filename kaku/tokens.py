@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+
+Access tokens issued by the token endpoint are signed with HMAC-SHA256
+and carry the me, client_id, scope and expiry of the grant so they can
+be verified without any Redis requests.
+
+Revoked tokens are kept in a Redis sorted set scored by their expiry
+and each worker keeps a copy of the set that is refreshed every few
+seconds. Tokens issued before signed tokens were used are looked up
+in Redis as before.
+"""
+
+import re
+import hmac
+import json
+import time
+import uuid
+import base64
+import hashlib
+
+
+revokedKey  = 'kaku-tokens::revoked'
+legacyToken = re.compile(r'^app-(?P<me>.+?)-(?P<client_id>https?://.+)-(?P<scope>[^-]*)$')
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+def decode(data):
+    return base64.urlsafe_b64decode(str(data) + '=' * (-len(data) % 4))
+
+def sign(secret, payload):
+    return encode(hmac.new(str(secret), payload, hashlib.sha256).digest())
+
+def createToken(secret, me, client_id, scope, lifetime):
+    """Return a signed access token valid for lifetime seconds.
+    """
+    payload = encode(json.dumps({ 'me':        me,
+                                  'client_id': client_id,
+                                  'scope':     scope,
+                                  'exp':       int(time.time() + lifetime),
+                                  'jti':       str(uuid.uuid4()),
+                                }, sort_keys=True))
+    return '%s.%s' % (payload, sign(secret, payload))
+
+def isSignedToken(token):
+    return token is not None and '.' in token
+
+def verifyToken(secret, token):
+    """Verify the signature and expiry of a signed access token.
+
+    Returns the token's claims or None if the token is not valid.
+    """
+    if not isSignedToken(token):
+        return None
+    try:
+        if isinstance(token, unicode):
+            token = token.encode('ascii')
+    except UnicodeError:
+        return None
+    payload, signature = token.rsplit('.', 1)
+    if not hmac.compare_digest(sign(secret, payload), signature):
+        return None
+    try:
+        claims = json.loads(decode(payload))
+    except (TypeError, ValueError):
+        return None
+    if claims.get('exp', 0) < time.time():
+        return None
+    return claims
+
+def parseLegacyToken(key):
+    """Return the me, client_id and scope from the Redis key of a token
+    issued before signed tokens were used, the key is app-<me>-<client_id>-<scope>.
+    """
+    m = legacyToken.match(key)
+    if m is None:
+        return None, None, None
+    return m.group('me'), m.group('client_id'), m.group('scope')
+
+def revokeToken(db, claims):
+    """Add a signed token to the revoked set until it would have expired.
+    """
+    now  = time.time()
+    pipe = db.pipeline()
+    pipe.zadd(db.key(revokedKey), { claims['jti']: claims['exp'] })
+    pipe.zremrangebyscore(db.key(revokedKey), 0, now)
+    pipe.execute()
+
+class RevokedTokens(object):
+    """A copy of the revoked token set that is refreshed from Redis
+    when it is older than ttl seconds.
+    """
+    def __init__(self, db, ttl=5):
+        self.db      = db
+        self.ttl     = ttl
+        self.tokens  = set()
+        self.expires = 0
+
+    def refresh(self):
+        now          = time.time()
+        self.tokens  = set(self.db.zrangebyscore(self.db.key(revokedKey), now, '+inf'))
+        self.expires = now + self.ttl
+
+    def isRevoked(self, claims):
+        if time.time() >= self.expires:
+            self.refresh()
+        return claims['jti'] in self.tokens
@@ -5,14 +5,14 @@
 """
 
 import os
-import json
-import uuid
-import requests
 
 from urlparse import urlparse
 
 from flask import current_app, session
 
+from kaku.events import publishEvent
+from kaku.tokens import isSignedToken, verifyToken, parseLegacyToken
+
 
 def kakuEvent(eventType, eventAction, eventData):
     """Publish a Kaku event.
@@ -25,24 +25,19 @@ def kakuEvent(eventType, eventAction, eventData):
     Event Data: a dictionary of items relevant to the event
 
     The event is stored in the location key generated and that
-    key is then published to the event queue.
+    key is then added to the event queue.
     """
-    key  = 'kaku-event::%s::%s::%s' % (eventType, eventAction, str(uuid.uuid4()))
-    data = { 'type':   eventType,
-             'action': eventAction,
-             'data':   eventData,
-             'key':    key
-           }
-    current_app.dbRedis.set(key, json.dumps(data))
-    current_app.dbRedis.publish(current_app.config['SITE_EVENTS'], key)
+    return publishEvent(current_app.dbRedis, current_app.config['SITE_EVENTS'], eventType, eventAction, eventData,
+                        current_app.config['EVENT_COMPRESS'])
 
 def clearAuth():
     if 'indieauth_token' in session:
         if current_app.dbRedis is not None:
-            key = current_app.dbRedis.get('token-%s' % session['indieauth_token'])
+            db       = current_app.dbRedis
+            tokenKey = db.key('token-%s' % session['indieauth_token'])
+            key      = db.get(tokenKey)
             if key:
-                current_app.dbRedis.delete(key)
-                current_app.dbRedis.delete('token-%s' % session['indieauth_token'])
+                db.delete(db.key(key), tokenKey)
     session.pop('indieauth_token', None)
     session.pop('indieauth_scope', None)
     session.pop('indieauth_id',    None)
@@ -55,21 +50,29 @@ def checkAuth():
         indieauth_id    = session['indieauth_id']
         indieauth_token = session['indieauth_token']
         if current_app.dbRedis is not None:
-            key = current_app.dbRedis.get('token-%s' % indieauth_token)
-            if key:
-                data = current_app.dbRedis.hgetall(key)
-                if data and data['token'] == indieauth_token:
-                    authed = True
+            data = current_app.dbRedis.hgetall(current_app.dbRedis.key('login-%s' % indieauth_id))
+            if data and data.get('token') == indieauth_token:
+                authed = True
     return authed, indieauth_id
 
+def tokenSecret():
+    return current_app.config['TOKEN_SECRET'] or current_app.config['SECRET_KEY']
+
 def checkAccessToken(access_token):
+    """Return the me, client_id and scope of a valid access token.
+
+    Signed tokens are verified without any Redis requests, only tokens
+    issued before signed tokens were used are looked up in Redis.
+    """
+    if isSignedToken(access_token):
+        claims = verifyToken(tokenSecret(), access_token)
+        if claims is not None and not current_app.revokedTokens.isRevoked(claims):
+            return claims['me'], claims['client_id'], claims['scope']
+        return None, None, None
     if access_token is not None and current_app.dbRedis is not None:
-        key = current_app.dbRedis.get('token-%s' % access_token)
+        key = current_app.dbRedis.get(current_app.dbRedis.key('token-%s' % access_token))
         if key:
-            data      = key.split('-')
-            me        = data[1]
-            client_id = data[2]
-            scope     = data[3]
+            me, client_id, scope = parseLegacyToken(key)
             current_app.logger.info('access token valid [%s] [%s] [%s]' % (me, client_id, scope))
             return me, client_id, scope
         else:
@@ -77,17 +80,6 @@ def checkAccessToken(access_token):
     else:
         return None, None, None
 
-def validURL(targetURL):
-    """Validate the target URL exists by making a HEAD request for it
-    """
-    result = 404
-    try:
-        r = requests.head(targetURL)
-        result = r.status_code
-    except:
-        result = 404
-    return result
-
 def extractHCard(mf2Data):
     result = { 'name': '',
                'url':  '',
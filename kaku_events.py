@@ -7,29 +7,172 @@
 
 import os
 import json
+import time
 import uuid
 import types
 import errno
+import socket
 import logging
 import datetime
+import hashlib
+import tempfile
 import argparse
+import contextlib
+import collections
+import threading
+import multiprocessing
 
 import pytz
-import redis
 import jinja2
 import ronkyuu
 import requests
 import markdown2
 
 from bs4 import BeautifulSoup
+from multiprocessing.pool import ThreadPool
 from logging.handlers import RotatingFileHandler
 from urlparse import urlparse
 from dateutil.parser import parse
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 from bearlib.config import Config, findConfigFile
 from bearlib.tools import normalizeFilename
 
+from kaku.store import KakuRedis
+from kaku.blobs import getBlob, releaseBlob
+from kaku.events import publishEvents, loadEvent, completeEvent, failEvent, retryEvents, replayDeadEvents, registerConsumer, claimEvent, ackEvent, reclaimEvents
+from kaku.discovery import discoverEndpoint
+from kaku.mentions import verifyMention, setMentionStatus, slimMention, targetRoute, resolveTarget, invalidateTarget
+
+
+logger      = logging.getLogger(__name__)
+indexKey       = 'kaku-index::posts'
+fingerprintKey = 'kaku-index::fingerprints'
+archiveKey     = 'kaku-archive::pages'
+archiveState   = 'kaku-archive::state'
+archiveDirty   = 'kaku-archive::dirty'
+feedKey        = 'kaku-feed::fingerprint'
+manifestKey    = 'kaku-manifest::posts'
+sweepKey       = 'kaku-sweep::mentions'
+workerLocal  = threading.local()
+templateEnv  = None
+atomTemplate = None
+mdCache      = collections.OrderedDict()
+mdCacheLock  = threading.Lock()
+fileMask     = os.umask(0)
+os.umask(fileMask)
+
+def cfgOption(key, default=None):
+    if key in cfg:
+        return cfg[key]
+    else:
+        return default
+
+def getMarkdown():
+    """Return the markdown2 processor for the current worker.
+
+    markdown2.Markdown instances keep state during convert()
+    so each worker thread is given its own.
+    """
+    if not hasattr(workerLocal, 'md'):
+        workerLocal.md = markdown2.Markdown(extras=cfg.markdown_extras)
+    return workerLocal.md
+
+def renderMarkdown(content):
+    """Convert the markdown content of a post to html.
+
+    Results are kept in an in-memory LRU cache of markdown_cache_size
+    entries (256 by default) keyed by a hash of the content and the
+    markdown_extras config. If markdown_cache is set to redis they are
+    also kept in Redis for markdown_cache_ttl seconds (one week by default)
+    so they are shared between worker processes and daemon restarts.
+    """
+    key = hashlib.sha1(json.dumps(cfg.markdown_extras) + content.encode('utf-8')).hexdigest()
+    with mdCacheLock:
+        html = mdCache.pop(key, None)
+        if html is not None:
+            mdCache[key] = html
+            return html
+
+    useRedis = cfgOption('markdown_cache') == 'redis'
+    if useRedis:
+        html = db.get(db.key('kaku-markdown::%s' % key))
+        if html is not None:
+            html = html.decode('utf-8')
+    if html is None:
+        html = getMarkdown().convert(content)
+        if useRedis:
+            db.set(db.key('kaku-markdown::%s' % key), html.encode('utf-8'), ex=cfgOption('markdown_cache_ttl', 604800))
+
+    with mdCacheLock:
+        mdCache[key] = html
+        while len(mdCache) > cfgOption('markdown_cache_size', 256):
+            mdCache.popitem(last=False)
+    return html
+
+def getTemplates():
+    """Return the template environment shared by all workers.
+
+    Compiled templates are kept in memory and their bytecode is cached
+    in the template_cache directory (the system temp directory if not set).
+    A template is recompiled only when its file has been modified.
+    """
+    global templateEnv
+    if templateEnv is None:
+        templateLoader = jinja2.FileSystemLoader(searchpath=cfg.paths.templates)
+        bytecodeCache  = jinja2.FileSystemBytecodeCache(directory=cfgOption('template_cache'))
+        templateEnv    = jinja2.Environment(loader=templateLoader, bytecode_cache=bytecodeCache, auto_reload=True)
+    return templateEnv
+
+# used when the templates config has no atom template
+atomFeed = u"""<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>{{ title|e }}</title>
+  <id>{{ feedURL|e }}</id>
+  <link rel="self" href="{{ feedURL|e }}"/>
+  <link rel="alternate" href="{{ siteURL|e }}"/>
+  <updated>{{ updated }}</updated>
+{%- for post in posts %}
+  <entry>
+    <title>{{ post.title|e }}</title>
+    <id>{{ post.link|e }}</id>
+    <link rel="alternate" href="{{ post.link|e }}"/>
+    <published>{{ post.publishedDate }}</published>
+    <updated>{{ post.updatedDate }}</updated>
+    <author><name>{{ post.authorName|e }}</name></author>
+    <summary>{{ post.summary|e }}</summary>
+    <content type="html">{{ post.xml }}</content>
+  </entry>
+{%- endfor %}
+</feed>
+"""
 
-logger = logging.getLogger(__name__)
+def getAtomTemplate():
+    """Return the atom feed template, either the configured one or the
+    default which is compiled once.
+    """
+    global atomTemplate
+    if 'atom' in cfg.templates:
+        return getTemplates().get_template(cfg.templates['atom'])
+    if atomTemplate is None:
+        atomTemplate = getTemplates().from_string(atomFeed)
+    return atomTemplate
+
+def workLock(name):
+    """Return a lock that serializes work on the named item.
+
+    The name is the targetFile of a post or 'index' for the index page.
+    The lock is held in Redis so it is shared by all workers, both
+    threads and processes, and it expires after lock_timeout seconds
+    in case a worker stops while holding it.
+    """
+    return db.lock(db.key('kaku-lock::%s' % name), timeout=cfgOption('lock_timeout', 600))
 
 def getTimestamp():
     utcdate   = datetime.datetime.utcnow()
@@ -58,30 +201,102 @@ def createPath(path, log):
     return result
 
 def escXML(text, escape_quotes=False):
-    if isinstance(text, types.UnicodeType):
-        s = list(text)
-    else:
+    """Escape &, < and > (and " if escape_quotes is True) for use in XML.
+
+    Byte strings and ints are converted to unicode first, any invalid
+    utf-8 sequences are dropped.
+    """
+    if not isinstance(text, types.UnicodeType):
         if isinstance(text, types.IntType):
-            s = str(text)
+            text = str(text)
+        text = unicode(text, 'utf-8', 'ignore')
+    text = text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;')
+    if escape_quotes:
+        text = text.replace(u'"', u'&quot;')
+    return text
+
+def resetTimings():
+    workerLocal.timings = {}
+
+def stageTimings():
+    """Return the seconds spent in each stage by the current worker since resetTimings().
+    """
+    if not hasattr(workerLocal, 'timings'):
+        resetTimings()
+    return workerLocal.timings
+
+@contextlib.contextmanager
+def timed(stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings        = stageTimings()
+        timings[stage] = timings.get(stage, 0.0) + time.time() - start
+
+def resetIOStats():
+    workerLocal.io = { 'written':      0,
+                       'skipped':      0,
+                       'bytesWritten': 0,
+                       'bytesSkipped': 0,
+                     }
+
+def ioStats():
+    """Return the file write counts of the current worker since resetIOStats().
+    """
+    if not hasattr(workerLocal, 'io'):
+        resetIOStats()
+    return workerLocal.io
+
+def writeFile(filename, data):
+    """Write data to filename atomically, skipping the write if the file
+    already holds the same bytes.
+
+    The data is written to a temporary file in the same directory which
+    is then renamed over filename so readers never see a partial file.
+    The fsync config item controls flushing to disk before the rename:
+      never - do not fsync (the default)
+      file  - fsync the temporary file
+      full  - fsync the temporary file and then the directory after the rename
+
+    Returns True if the file was written.
+    """
+    stats = ioStats()
+    if os.path.exists(filename) and os.path.getsize(filename) == len(data):
+        with open(filename, 'rb') as h:
+            if h.read() == data:
+                stats['skipped']      += 1
+                stats['bytesSkipped'] += len(data)
+                return False
+
+    policy   = cfgOption('fsync', 'never')
+    path     = os.path.dirname(filename)
+    fd, temp = tempfile.mkstemp(dir=path, prefix='.%s.' % os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'wb') as h:
+            h.write(data)
+            if policy in ('file', 'full'):
+                h.flush()
+                os.fsync(h.fileno())
+        if os.path.exists(filename):
+            os.chmod(temp, os.stat(filename).st_mode & 0o777)
         else:
-            s = text
-        s = list(unicode(s, 'utf-8', 'ignore'))
-
-    cc      = 0
-    matches = ('&', '<', '"', '>')
-
-    for c in s:
-        if c in matches:
-            if c == '&':
-                s[cc] = u'&amp;'
-            elif c == '<':
-                s[cc] = u'&lt;'
-            elif c == '>':
-                s[cc] = u'&gt;'
-            elif escape_quotes:
-                s[cc] = u'&quot;'
-        cc += 1
-    return ''.join(s)
+            os.chmod(temp, 0o666 & ~fileMask)
+        os.rename(temp, filename)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    if policy == 'full':
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    stats['written']      += 1
+    stats['bytesWritten'] += len(data)
+    return True
 
 def readMD(targetFile):
     result  = {}
@@ -108,8 +323,7 @@ def readMD(targetFile):
 
 def writeMD(targetFile, data):
     page = mdPost % data
-    with open('%s.md' % targetFile, 'w+') as h:
-        h.write(page.encode('utf-8'))
+    writeFile('%s.md' % targetFile, page.encode('utf-8'))
 
 def loadMetadata(targetFile):
     mdData = readMD(targetFile)
@@ -149,32 +363,175 @@ def saveMetadata(targetFile, data):
     for key in ('created', 'published', 'updated', 'deleted'):
         if key in data:
             data[key] = data[key].strftime('%Y-%m-%d %H:%M:%S')
-    with open('%s.json' % targetFile, 'w+') as h:
-        h.write(json.dumps(data, indent=2))
+    writeFile('%s.json' % targetFile, json.dumps(data, indent=2))
+
+def mentionsKey(targetFile):
+    return db.key('kaku-mentions::%s' % targetFile)
+
+def mentionKey(sourceURL):
+    """Return the key of a mention within its post's mention store.
+
+    sourceURL: the parsed source URL of the mention
+    """
+    return 'mention::%s::%s' % (sourceURL.netloc, sourceURL.path)
+
+def mentionRef(targetFile, key):
+    """Return the reference a mention holds to its mf2 data in the blob store.
+    """
+    return json.dumps([targetFile, key])
+
+def migrateMentions(targetFile):
+    """Move the mentions in a post's .mentions file into its mention store.
+
+    Each mention is stored under the key of its source URL, mentions already
+    in the store are kept, and its mf2 data is moved to the blob store. The
+    file is renamed to .mentions.migrated once done. Returns the number of
+    mentions migrated.
+    """
+    mentionsFile = '%s.mentions' % targetFile
+    if not os.path.exists(mentionsFile):
+        return 0
+    with open(mentionsFile, 'r') as h:
+        mentions = json.load(h)
+    if len(mentions) > 0:
+        pipe = db.pipeline()
+        for item in mentions:
+            record = mentions[item]
+            key    = mentionKey(urlparse(record['mention']['sourceURL']))
+            slimMention(db, record['mention'], mentionRef(targetFile, key))
+            pipe.hsetnx(mentionsKey(targetFile), key, json.dumps(record))
+        pipe.execute()
+    os.rename(mentionsFile, '%s.migrated' % mentionsFile)
+    logger.info('migrated %d mentions of [%s]' % (len(mentions), targetFile))
+    return len(mentions)
+
+def slimMentions(targetFile):
+    """Move the mf2 data of any mention of a post still holding it into the
+    blob store. Returns the number of mentions changed.
+    """
+    records = {}
+    for key, value in db.hgetall(mentionsKey(targetFile)).items():
+        record = json.loads(value)
+        if 'mf2data' in record['mention']:
+            slimMention(db, record['mention'], mentionRef(targetFile, key))
+            records[key] = json.dumps(record)
+    if len(records) > 0:
+        db.hmset(mentionsKey(targetFile), records)
+    return len(records)
+
+def migrateAllMentions():
+    """Migrate the .mentions file of every post and move the mf2 data of
+    every stored mention into the blob store.
+    """
+    result = 0
+    for targetFile, st, deleted in scanContent(cfg.paths.content):
+        with workLock(targetFile):
+            if os.path.exists('%s.mentions' % targetFile):
+                result += migrateMentions(targetFile)
+            result += slimMentions(targetFile)
+    return result
 
 def loadOurWebmentions(targetFile):
+    """Return all of the mentions of a post as a dict of mention key to record.
+
+    Any .mentions file left from before the mention store is migrated first.
+    """
+    migrateMentions(targetFile)
     result = {}
-    if os.path.exists('%s.mentions' % targetFile):
-        with open('%s.mentions' % targetFile, 'r') as h:
-            result = json.load(h)
+    for key, value in db.hgetall(mentionsKey(targetFile)).items():
+        result[key] = json.loads(value)
     return result
 
-def saveOurMentions(targetFile, mentions):
-    logger.info('saving webmentions for %s' % targetFile)
-    with open('%s.mentions' % targetFile, 'w+') as h:
-        h.write(json.dumps(mentions, indent=2))
-
-def scanOurMentions(sourceURL, mentions):
-    # loop thru to see if this mention is already present
-    found = None
-    for key in mentions:
-        item = mentions[key]['mention']
-        url  = urlparse(item['sourceURL'])
-        if url.netloc == sourceURL.netloc and url.path == sourceURL.path:
-            found = key
-            break
-    logger.info('scanOurMentions result [%s]' % found)
-    return found
+def loadOurMention(targetFile, key):
+    """Return the record for a single mention of a post or None.
+    """
+    migrateMentions(targetFile)
+    value = db.hget(mentionsKey(targetFile), key)
+    if value is None:
+        return None
+    return json.loads(value)
+
+def saveOurMention(targetFile, key, record, previous=None):
+    """Save a mention of a post, moving any mf2 data it holds to the blob store.
+
+    previous is the digest of the mf2 data the mention referred to before,
+    it is released if the mention now refers to different data.
+    """
+    logger.info('saving webmention [%s] for %s' % (key, targetFile))
+    slimMention(db, record['mention'], mentionRef(targetFile, key))
+    db.hset(mentionsKey(targetFile), key, json.dumps(record))
+    if previous is not None and previous != record['mention'].get('mf2'):
+        releaseBlob(db, previous, mentionRef(targetFile, key))
+
+def deleteOurMention(targetFile, key):
+    """Remove a mention from a post and release its mf2 data.
+
+    Returns True if the mention was present.
+    """
+    pipe = db.pipeline()
+    pipe.hget(mentionsKey(targetFile), key)
+    pipe.hdel(mentionsKey(targetFile), key)
+    value, removed = pipe.execute()
+    if value is not None:
+        digest = json.loads(value)['mention'].get('mf2')
+        if digest is not None:
+            releaseBlob(db, digest, mentionRef(targetFile, key))
+    return removed > 0
+
+def archiveMentions(targetFile):
+    """Move the mentions of a deleted post out of Redis into its
+    .mentions.deleted file, from where they are restored if the post
+    is undeleted.
+
+    Their mf2 data is moved out of the blob store with them and they are
+    no longer checked by the sweeper. Returns the number of mentions archived.
+    """
+    records = db.hgetall(mentionsKey(targetFile))
+    if len(records) == 0:
+        return 0
+    archived     = {}
+    archivedFile = '%s.mentions.deleted' % targetFile
+    if os.path.exists(archivedFile):
+        with open(archivedFile, 'r') as h:
+            archived = json.load(h)
+    pipe = db.pipeline()
+    for key, value in records.items():
+        record = json.loads(value)
+        digest = record['mention'].pop('mf2', None)
+        if digest is not None:
+            record['mention']['mf2data'] = getBlob(db, digest)
+            releaseBlob(db, digest, mentionRef(targetFile, key))
+        pipe.zrem(db.key(sweepKey), mentionRef(targetFile, key))
+        archived[key] = record
+    writeFile(archivedFile, json.dumps(archived, indent=2))
+    pipe.delete(mentionsKey(targetFile))
+    pipe.execute()
+    logger.info('archived %d mentions of deleted post [%s]' % (len(records), targetFile))
+    return len(records)
+
+def restoreMentions(targetFile):
+    """Return the mentions archived when a post was deleted to its mention store.
+
+    Mentions added since are kept, and the mf2 data is moved back into the
+    blob store. Returns the number of mentions restored.
+    """
+    archivedFile = '%s.mentions.deleted' % targetFile
+    if not os.path.exists(archivedFile):
+        return 0
+    with open(archivedFile, 'r') as h:
+        archived = json.load(h)
+    if len(archived) > 0:
+        pipe = db.pipeline()
+        for key in archived:
+            record = archived[key]
+            if db.hexists(mentionsKey(targetFile), key):
+                continue
+            slimMention(db, record['mention'], mentionRef(targetFile, key))
+            pipe.hsetnx(mentionsKey(targetFile), key, json.dumps(record))
+        pipe.execute()
+    os.remove(archivedFile)
+    logger.info('restored %d mentions of [%s]' % (len(archived), targetFile))
+    return len(archived)
 
 def loadOutboundWebmentions(targetFile):
     result = {}
@@ -185,8 +542,61 @@ def loadOutboundWebmentions(targetFile):
 
 def saveOutboundWebmentions(targetFile, mentions):
     logger.info('saving outbound webmentions from %s' % targetFile)
-    with open('%s.outboundmentions' % targetFile, 'w+') as h:
-        h.write(json.dumps(mentions, indent=2))
+    writeFile('%s.outboundmentions' % targetFile, json.dumps(mentions, indent=2))
+
+def sendOutboundWebmention(sourceURL, href, hostLimits):
+    """Discover the Webmention endpoint for href and send the Webmention.
+
+    hostLimits is a dict of semaphores, one per host, that caps the
+    number of concurrent requests made to any one host.
+
+    Returns a tuple of the discovery status, the endpoint URL and the
+    response from the Webmention POST or None if it was not sent.
+    """
+    wmStatus = None
+    wmUrl    = None
+    resp     = None
+    try:
+        with hostLimits[urlparse(href).netloc]:
+            wmStatus, wmUrl, debug = discoverEndpoint(db, href, cfgOption('discovery_ttl', 86400),
+                                                      cfgOption('discovery_negative_ttl', 3600),
+                                                      cfgOption('discovery_timeout', 10))
+            logger.info('webmention endpoint discovery: %s [%s]' % (wmStatus, wmUrl))
+
+            if len(debug) > 0:
+                logger.info('\n\tdebug: '.join(debug))
+            if wmUrl is not None and wmStatus == 200:
+                logger.info('\tfound webmention endpoint %s for %s' % (wmUrl, href))
+                resp, debug = ronkyuu.sendWebmention(sourceURL, href, wmUrl, debug=True)
+                if len(debug) > 0:
+                    logger.info('\n\tdebug: '.join(debug))
+    except:
+        logger.exception('exception sending webmention to [%s]' % href)
+    return wmStatus, wmUrl, resp
+
+def sendOutboundWebmentions(sourceURL, hrefs):
+    """Send Webmentions from sourceURL to each of the hrefs concurrently.
+
+    The sends are run in a pool of outbound_workers threads (8 by default)
+    with at most outbound_per_host (2 by default) running against any one host.
+
+    Returns the sendOutboundWebmention() results in the same order as hrefs.
+    """
+    results = []
+    if len(hrefs) > 0:
+        perHost    = cfgOption('outbound_per_host', 2)
+        hostLimits = {}
+        for href in hrefs:
+            host = urlparse(href).netloc
+            if host not in hostLimits:
+                hostLimits[host] = threading.BoundedSemaphore(perHost)
+        pool = ThreadPool(min(cfgOption('outbound_workers', 8), len(hrefs)))
+        try:
+            results = pool.map(lambda href: sendOutboundWebmention(sourceURL, href, hostLimits), hrefs)
+        finally:
+            pool.close()
+            pool.join()
+    return results
 
 def checkOutboundWebmentions(sourceURL, html, targetFile, update=False):
     logger.info('checking for outbound webmentions [%s]' % sourceURL)
@@ -201,7 +611,7 @@ def checkOutboundWebmentions(sourceURL, html, targetFile, update=False):
             if sourceURL != href:
                 logger.info(href)
                 key     = 'webmention::%s::%s' % (sourceURL, href)
-                keySeen = db.exists(key)
+                keySeen = db.exists(db.key(key))
                 if keySeen:
                     if update:
                         keySeen = False
@@ -224,6 +634,7 @@ def checkOutboundWebmentions(sourceURL, html, targetFile, update=False):
                 if 'keySeen' not in mentions[key]:
                     mentions[key]['keySeen'] = False
         removed = []
+        pending = []
         for key in mentions:
             mention = mentions[key]
             logger.info('seen: %(keySeen)s removed: %(removed)s [%(key)s]' % mention)
@@ -232,61 +643,103 @@ def checkOutboundWebmentions(sourceURL, html, targetFile, update=False):
             if mention['removed'] or not mention['keySeen']:
                 if mention['removed']:
                     removed.append(key)
-
-                href = mention['href']
-                wmStatus, wmUrl, debug = ronkyuu.discoverEndpoint(href, test_urls=False, debug=True)
-                logger.info('webmention endpoint discovery: %s [%s]' % (wmStatus, wmUrl))
-
-                if len(debug) > 0:
-                    logger.info('\n\tdebug: '.join(debug))
-                if wmUrl is not None and wmStatus == 200:
-                    logger.info('\tfound webmention endpoint %s for %s' % (wmUrl, href))
-                    resp, debug = ronkyuu.sendWebmention(sourceURL, href, wmUrl, debug=True)
-                    if len(debug) > 0:
-                        logger.info('\n\tdebug: '.join(debug))
-                    if resp.status_code == requests.codes.ok:
-                        if key not in cached:
-                            cached[key] = { 'key':    key,
-                                            'href':   href,
-                                            'wmUrl':  wmUrl,
-                                            'status': resp.status_code
-                                          }
-                        if len(resp.history) == 0:
-                            db.set(key, resp.status_code)
-                            logger.info('\twebmention sent successfully')
-                        else:
-                            logger.info('\twebmention POST was redirected')
+                pending.append(key)
+
+        results = sendOutboundWebmentions(sourceURL, [mentions[key]['href'] for key in pending])
+        for key, result in zip(pending, results):
+            href                  = mentions[key]['href']
+            wmStatus, wmUrl, resp = result
+            if resp is not None:
+                if resp.status_code == requests.codes.ok:
+                    if key not in cached:
+                        cached[key] = { 'key':    key,
+                                        'href':   href,
+                                        'wmUrl':  wmUrl,
+                                        'status': resp.status_code
+                                      }
+                    if len(resp.history) == 0:
+                        db.set(db.key(key), resp.status_code)
+                        logger.info('\twebmention sent successfully [%s]' % key)
                     else:
-                        logger.info('\twebmention send returned a status code of %s' % resp.status_code)
+                        logger.info('\twebmention POST was redirected [%s]' % key)
+                else:
+                    logger.info('\twebmention send returned a status code of %s [%s]' % (resp.status_code, key))
         for key in removed:
             del cached[key]
-            db.delete(key)
+            db.delete(db.key(key))
 
         saveOutboundWebmentions(targetFile, cached)
     except:
         logger.exception('exception during checkOutboundWebmentions')
 
-def postUpdate(targetFile, action=None):
+def templateStamp():
+    """Return the name and mtime of every template file.
+    """
+    result = []
+    for entry in sorted(scandir(cfg.paths.templates), key=lambda e: e.name):
+        result.append('%s %s' % (entry.name, entry.stat().st_mtime))
+    return '\n'.join(result)
+
+def renderFingerprint(targetFile, ourMentions):
+    """Return a hash of everything that affects the generated files of a post.
+
+    This covers the markdown file, the deleted flag, the mentions passed
+    to the templates, the mtimes of the template files, the meta embed and
+    the site config items used while generating the post. The details
+    kept with each mention for its liveness checks, such as its ETag, are
+    left out as they do not change the generated files.
+    """
+    h = hashlib.sha1()
+    with open('%s.md' % targetFile, 'rb') as f:
+        h.update(f.read())
+    h.update(str(os.path.exists('%s.deleted' % targetFile)))
+    h.update(json.dumps([[key, ourMentions[key]['mention']] for key in sorted(ourMentions)], sort_keys=True))
+    h.update(templateStamp())
+    h.update(metaEmbed)
+    h.update(json.dumps([cfg.title, cfg.baseurl, cfg.baseroute, cfg.markdown_extras]))
+    return h.hexdigest()
+
+def postUpdate(targetFile, action=None, force=False, outbound=True, updated=False):
     """Generate data for targeted file.
 
-    All mentions to the post are checked for updates.
-    The post is also scanned for any outbound Webmentions.
+    Nothing is generated if the render fingerprint of the post matches the
+    one saved when the post was last generated and its files still exist,
+    unless force is True.
+
+    Mentions of the post are scheduled for liveness checks by sweepMentions(),
+    no remote requests are made for them here. The mentions of a deleted
+    post are archived to a file and restored when it is undeleted.
+    If outbound is True the post is also scanned for any outbound Webmentions.
+    The post's updated timestamp is set for an update action or if updated is True.
 
     targetFile: path and filename without extension.
     """
     pageEnv          = {}
-    templateLoader   = jinja2.FileSystemLoader(searchpath=cfg.paths.templates)
-    templates        = jinja2.Environment(loader=templateLoader)
+    templates        = getTemplates()
     postTemplate     = templates.get_template(cfg.templates['post'])
     postPageTemplate = templates.get_template(cfg.templates['postPage'])
-    post             = loadMetadata(targetFile)
-    ourMentions      = loadOurWebmentions(targetFile)
+    with timed('load'):
+        post = loadMetadata(targetFile)
+        if os.path.exists('%s.deleted' % targetFile):
+            archiveMentions(targetFile)
+        else:
+            restoreMentions(targetFile)
+        ourMentions = loadOurWebmentions(targetFile)
+        fingerprint = renderFingerprint(targetFile, ourMentions)
+    htmlDir          = os.path.join(cfg.paths.output, post['year'], post['doy'])
+    htmlFile         = os.path.join(htmlDir, '%s.html' % post['slug'])
+
+    if not force and post.get('fingerprint') == fingerprint and \
+       os.path.exists('%s.html' % targetFile) and os.path.exists(htmlFile):
+        logger.info('post [%s] is unchanged, skipping' % targetFile)
+        return
+    post['fingerprint'] = fingerprint
 
     # bring over site config items
     for s in ('title',):
         pageEnv[s] = cfg[s]
 
-    if action == 'update':
+    if action == 'update' or updated:
         post['updated'] = getTimestamp()
 
     if os.path.exists('%s.deleted' % targetFile):
@@ -299,61 +752,43 @@ def postUpdate(targetFile, action=None):
         pageEnv['mentions'] = []
     else:
         logger.info('updating post [%s]' % targetFile)
-        post['html'] = md.convert(post['content'])
+        with timed('markdown'):
+            post['html'] = renderMarkdown(post['content'])
         if 'deleted' in post:
             del post['deleted']
-        removed = []
-        for key in ourMentions:
-            m = ourMentions[key]['mention']
-            r = requests.get(m['sourceURL'], verify=True)
-
-            if r.status_code == 410:
-                logger.info('a mention no longer exists - removing [%s]' % key)
-                removed.append(key)
-            else:
-                if 'charset' in r.headers.get('content-type', ''):
-                    content = r.text
-                else:
-                    content = r.content
-                soup   = BeautifulSoup(content, 'html5lib')
-                status = None
-                for meta in soup.findAll('meta', attrs={'http-equiv': lambda x: x and x.lower() == 'status'}):
-                    try:
-                        status = int(meta['content'].split(' ')[0])
-                    except:
-                        pass
-                if status == 410:
-                    logger.info('a mention no longer exists (via http-equiv) - removing [%s]' % key)
-                    removed.append(key)
-        for key in removed:
-            del ourMentions[key]
+        scheduleMentions(targetFile, ourMentions)
         mentions = []
         for key in ourMentions:
             m = ourMentions[key]['mention']
             # convert string dates into datetime's for template processing
             if 'postDate' in m:
                 m['postDate'] = parse(m['postDate'])
+            # templates that still use the full mf2 data can ask for it
+            if cfgOption('mention_mf2', False) and 'mf2' in m:
+                m['mf2data'] = getBlob(db, m['mf2'])
             mentions.append(m)
         pageEnv['title']    = post['title']
         pageEnv['mentions'] = mentions
         pageEnv['meta']     = metaEmbed % post
 
-    post['xml']     = escXML(post['html'])
-    pageEnv['post'] = post
-    postHtml        = postTemplate.render(pageEnv)
-    postPage        = postPageTemplate.render(pageEnv)
+    with timed('render'):
+        post['xml']     = escXML(post['html'])
+        pageEnv['post'] = post
+        postHtml        = postTemplate.render(pageEnv)
+        postPage        = postPageTemplate.render(pageEnv)
 
-    with open('%s.html' % targetFile, 'w+') as h:
-        h.write(postHtml.encode('utf-8'))
+    with timed('write'):
+        writeFile('%s.html' % targetFile, postHtml.encode('utf-8'))
 
-    htmlDir = os.path.join(cfg.paths.output, post['year'], post['doy'])
-    if not os.path.exists(htmlDir):
-        mkpath(htmlDir)
-    with open(os.path.join(htmlDir, '%s.html' % post['slug']), 'w+') as h:
-        h.write(postPage.encode('utf-8'))
+        if not os.path.exists(htmlDir):
+            mkpath(htmlDir)
+        writeFile(htmlFile, postPage.encode('utf-8'))
 
-    saveMetadata(targetFile, post)
-    checkOutboundWebmentions('%s%s' % (cfg.baseurl, post['url']), postHtml, targetFile, update=True)
+        saveMetadata(targetFile, post)
+        indexPost(targetFile, post)
+    if outbound:
+        with timed('outbound'):
+            checkOutboundWebmentions('%s%s' % (cfg.baseurl, post['url']), postHtml, targetFile, update=True)
 
 def checkPost(targetFile, eventData):
     """Check if the post's markdown file is present and create it if not.
@@ -392,52 +827,303 @@ def checkPost(targetFile, eventData):
         else:
             logger.error('checkPost for [%s] - no Micropub data included' % targetFile)
 
-def mentionDelete(mention):
+def mentionTarget(targetURL):
+    """Return the targetFile for the post a mention refers to.
+    """
+    targetFile = os.path.join(cfg.paths.content, targetRoute(targetURL, cfg.baseroute))
+
+    logger.info('targetFile [%s]' % targetFile)
+    return targetFile
+
+class RenderBatch(object):
+    """The posts to generate once a batch of events has been handled.
+
+    Each post is generated once for the batch using the strongest of
+    the actions given for it. Delete and undelete outrank create, which
+    outranks update; between delete and undelete the latest one wins.
+    A post that is both created and updated is generated as a create
+    that still records the update's timestamp.
+
+    The events that added each post are recorded so that an event is only
+    completed once all of its posts have been generated, as are the
+    manifest entries to save for gathered posts once they are generated.
+    A post added by a forced event is generated even if its render
+    fingerprint is unchanged.
+    """
+    ranks = { None:       0,
+              'update':   1,
+              'create':   2,
+              'delete':   3,
+              'undelete': 3,
+            }
+
+    def __init__(self):
+        self.posts   = {}
+        self.index   = False
+        self.event   = None
+        self.handled  = []
+        self.sources  = {}
+        self.manifest = {}
+        self.updates  = set()
+        self.forced   = set()
+
+    def add(self, targetFile, action=None, manifest=None, force=False):
+        if targetFile not in self.posts or self.ranks[action] >= self.ranks[self.posts[targetFile]]:
+            self.posts[targetFile] = action
+        if action == 'update':
+            self.updates.add(targetFile)
+        if self.event is not None:
+            self.sources.setdefault(targetFile, set()).add(self.event)
+        if manifest is not None:
+            self.manifest[targetFile] = manifest
+        if force:
+            self.forced.add(targetFile)
+
+    def updated(self, targetFile):
+        """Return True if the post's updated timestamp is to be set.
+        """
+        return targetFile in self.updates and self.posts[targetFile] in ('create', 'update')
+
+def renderBatch(batch):
+    """Generate each post in the batch and then, if needed, the index page.
+
+    The handled events of the batch are then completed, except for those
+    that added a post that could not be generated, which are failed so
+    they are retried. If the index page cannot be generated every handled
+    event is failed.
+    """
+    failed  = set()
+    entries = {}
+    for targetFile in batch.posts:
+        try:
+            with workLock(targetFile):
+                postUpdate(targetFile, batch.posts[targetFile], force=targetFile in batch.forced,
+                           updated=batch.updated(targetFile))
+            if targetFile in batch.manifest:
+                entries[targetFile] = json.dumps(batch.manifest[targetFile])
+        except:
+            logger.exception('error generating post [%s]' % targetFile)
+            failed.update(batch.sources.get(targetFile, ()))
+    if len(entries) > 0:
+        db.hmset(db.key(manifestKey), entries)
+    if batch.index:
+        try:
+            indexUpdate()
+        except:
+            logger.exception('error generating the index page')
+            failed.update(batch.handled)
+    for eventKey in batch.handled:
+        if eventKey in failed:
+            retryEvent(eventKey)
+        else:
+            completeEvent(db, cfg.events, eventKey, cfgOption('event_ttl', 86400))
+
+def mentionDelete(mention, batch):
     logger.info('mention delete of [%s] within [%s]' % (mention['targetURL'], mention['sourceURL']))
-    # update() handles removal of out of date mentions
-    targetURL   = urlparse(mention['targetURL'])
-    targetRoute = targetURL.path.replace(cfg.baseroute, '')
-    postUpdate(os.path.join(cfg.paths.content, targetRoute))
 
-def mentionUpdate(mention):
+    sourceURL  = urlparse(mention['sourceURL'])
+    targetFile = mentionTarget(mention['targetURL'])
+
+    with workLock(targetFile):
+        migrateMentions(targetFile)
+        key = mentionKey(sourceURL)
+
+        if deleteOurMention(targetFile, key):
+            logger.info('removed mention of [%s] within [%s]' % (key, mention['targetURL']))
+            unscheduleMention(targetFile, key)
+            batch.add(targetFile)
+
+def mentionUpdate(mention, batch):
     logger.info('mention update of [%s] within [%s]' % (mention['targetURL'], mention['sourceURL']))
 
-    targetPath = urlparse(mention['targetURL'].strip()).path
-    pathItems  = targetPath.split('.')
-    logger.info('[%s] %s' % (targetPath, pathItems))
-    if pathItems[-1].lower() == 'html':
-        targetPath = '.'.join(pathItems[:-1])
+    eventDate  = getTimestamp()
+    sourceURL  = urlparse(mention['sourceURL'])
+    targetFile = mentionTarget(mention['targetURL'])
 
-    eventDate   = getTimestamp()
-    sourceURL   = urlparse(mention['sourceURL'])
-    targetRoute = targetPath.replace(cfg.baseroute, '')
-    targetFile  = os.path.join(cfg.paths.content, targetRoute)
+    with workLock(targetFile):
+        key    = mentionKey(sourceURL)
+        record = loadOurMention(targetFile, key)
 
-    logger.info('targetFile [%s]' % targetFile)
+        if record is not None:
+            logger.info('updated mention of [%s] within [%s]' % (key, mention['targetURL']))
+            previous          = record['mention'].get('mf2')
+            record['updated'] = eventDate.strftime('%Y-%m-%dT%H:%M:%S')
+            record['mention'] = mention
+        else:
+            previous = None
+            record   = { 'created': mention['postDate'],
+                         'updated': None,
+                         'mention': mention,
+                       }
+            logger.info('added mention of [%s] within [%s]' % (key, mention['targetURL']))
+
+        saveOurMention(targetFile, key, record, previous)
+    batch.add(targetFile)
+
+def mentionCheckInterval(record):
+    """Return the number of seconds until a mention should be checked again.
+
+    The interval is a quarter of the mention's age, so new mentions are
+    checked often and old ones rarely, bounded by sweep_min_interval
+    (one hour) and sweep_max_interval (one week). A mention without a
+    valid created date is checked after sweep_min_interval.
+    """
+    created = record.get('created')
+    age     = 0
+    if created is not None:
+        try:
+            age = (getTimestamp().replace(tzinfo=None) - parse(created).replace(tzinfo=None)).total_seconds()
+        except (ValueError, OverflowError, TypeError):
+            logger.warning('invalid mention date [%s]' % created)
+    return int(max(cfgOption('sweep_min_interval', 3600),
+                   min(cfgOption('sweep_max_interval', 604800), age / 4)))
+
+def scheduleMentions(targetFile, ourMentions):
+    """Make sure every mention of the post is scheduled for a liveness check.
+
+    Mentions that are already scheduled keep their current schedule.
+    """
+    if len(ourMentions) > 0:
+        now  = time.time()
+        pipe = db.pipeline()
+        for key in ourMentions:
+            member = json.dumps([targetFile, key])
+            pipe.zadd(db.key(sweepKey), { member: now + mentionCheckInterval(ourMentions[key]) }, nx=True)
+        pipe.execute()
+
+def unscheduleMention(targetFile, key):
+    db.zrem(db.key(sweepKey), json.dumps([targetFile, key]))
+
+def checkMention(record):
+    """Check if the source of a mention still exists.
+
+    A conditional GET is made using the ETag and Last-Modified values
+    stored with the mention from the previous check.
+
+    Returns True if the source is gone, either with a 410 status or with
+    a 410 http-equiv Status meta tag. A source that does not respond within
+    sweep_timeout seconds (10 by default) is not gone.
+    """
+    m       = record['mention']
+    headers = {}
+    if record.get('etag'):
+        headers['If-None-Match'] = record['etag']
+    if record.get('lastModified'):
+        headers['If-Modified-Since'] = record['lastModified']
+    try:
+        r = requests.get(m['sourceURL'], verify=True, headers=headers, timeout=cfgOption('sweep_timeout', 10))
+    except requests.exceptions.Timeout:
+        logger.warning('timed out checking mention source [%s]' % m['sourceURL'])
+        return False
+
+    if r.status_code == requests.codes.not_modified:
+        return False
+    if r.status_code == 410:
+        return True
 
-    ourMentions = loadOurWebmentions(targetFile)
-    found       = scanOurMentions(sourceURL, ourMentions)
+    record['etag']         = r.headers.get('etag')
+    record['lastModified'] = r.headers.get('last-modified')
 
-    if found is not None:
-        logger.info('updated mention of [%s] within [%s]' % (found, mention['targetURL']))
-        ourMentions[found]['updated'] = eventDate.strftime('%Y-%m-%dT%H:%M:%S')
-        ourMentions[found]['mention'] = mention
+    if 'charset' in r.headers.get('content-type', ''):
+        content = r.text
     else:
-        key              = 'mention::%s::%s' % (sourceURL.netloc, sourceURL.path)
-        ourMentions[key] = { 'created': mention['postDate'],
-                             'updated': None,
-                             'mention': mention,
-                           }
-        logger.info('added mention of [%s] within [%s]' % (key, mention['targetURL']))
+        content = r.content
+    soup   = BeautifulSoup(content, 'html5lib')
+    status = None
+    for meta in soup.findAll('meta', attrs={'http-equiv': lambda x: x and x.lower() == 'status'}):
+        try:
+            status = int(meta['content'].split(' ')[0])
+        except:
+            pass
+    return status == 410
 
-    saveOurMentions(targetFile, ourMentions)
-    postUpdate(targetFile)
+def sweepMentions(limit=100):
+    """Check the mentions that are due for a liveness check.
 
-def indexUpdate():
-    """Scan all posts and generate the index page.
+    A mention is claimed by removing it from the schedule, so only one
+    sweeper checks it, and it is rescheduled after the check. The source
+    is fetched without holding the post's lock, the mention is read again
+    once the lock is retaken so changes made during the fetch are kept.
+    The post is only generated again when a mention has been removed.
+
+    Returns the number of mentions checked.
     """
-    frontpage = {}
-    logger.info('building index page')
+    result = 0
+    for member in db.zrangebyscore(db.key(sweepKey), 0, time.time(), start=0, num=limit):
+        if db.zrem(db.key(sweepKey), member) == 0:
+            continue
+        result         += 1
+        targetFile, key = json.loads(member)
+        with workLock(targetFile):
+            record = loadOurMention(targetFile, key)
+        if record is None:
+            continue
+        try:
+            gone = checkMention(record)
+        except:
+            logger.exception('exception checking mention [%s]' % key)
+            gone = False
+        with workLock(targetFile):
+            current = loadOurMention(targetFile, key)
+            if current is None:
+                continue
+            if gone:
+                logger.info('a mention no longer exists - removing [%s]' % key)
+                deleteOurMention(targetFile, key)
+                postUpdate(targetFile)
+            else:
+                validators = (record.get('etag'), record.get('lastModified'))
+                if validators != (current.get('etag'), current.get('lastModified')):
+                    current['etag'], current['lastModified'] = validators
+                    saveOurMention(targetFile, key, current)
+                db.zadd(db.key(sweepKey), { member: time.time() + mentionCheckInterval(current) })
+    return result
+
+def sweeper(interval):
+    """Run sweepMentions() every interval seconds.
+    """
+    while True:
+        try:
+            n = sweepMentions()
+            if n > 0:
+                logger.info('checked %d mentions' % n)
+        except:
+            logger.exception('exception during mention sweep')
+        time.sleep(interval)
+
+def indexPost(targetFile, post):
+    """Add or remove a post from the persistent post index.
+
+    The index is a sorted set of post files scored by the post key
+    so the most recent posts can be read without walking the content tree.
+    Deleted posts are removed from the index.
+    The render fingerprint of each post is kept alongside the index
+    and is used to find the archive pages that need to be generated.
+    The post's score, and its previous score if it has changed, is added
+    to the set of scores the next archiveUpdate() starts from.
+    Any cached Webmention target resolution of the post is removed.
+    """
+    score = int(post['key'])
+    pipe  = db.pipeline()
+    pipe.zscore(db.key(indexKey), targetFile)
+    invalidateTarget(pipe, post['route'])
+    if os.path.exists('%s.deleted' % targetFile):
+        pipe.zrem(db.key(indexKey), targetFile)
+        pipe.hdel(db.key(fingerprintKey), targetFile)
+    else:
+        pipe.zadd(db.key(indexKey), { targetFile: score })
+        pipe.hset(db.key(fingerprintKey), targetFile, post.get('fingerprint', ''))
+    pipe.sadd(db.key(archiveDirty), score)
+    previous = pipe.execute()[0]
+    if previous is not None and int(previous) != score:
+        db.sadd(db.key(archiveDirty), int(previous))
+
+def rebuildIndex():
+    """Scan all posts and regenerate the post index from scratch.
+    """
+    posts        = {}
+    fingerprints = {}
+    logger.info('rebuilding post index')
     for path, dirlist, filelist in os.walk(cfg.paths.content):
         if len(filelist) > 0:
             for item in filelist:
@@ -446,27 +1132,320 @@ def indexUpdate():
                     if os.path.exists(os.path.join(path, '%s.deleted' % filename)):
                         logger.info('skipping deleted post [%s]' % filename)
                     else:
-                        page = loadMetadata(os.path.join(path, filename))
-                        frontpage[page['key']] = page
-    templateLoader = jinja2.FileSystemLoader(searchpath=cfg.paths.templates)
-    templates      = jinja2.Environment(loader=templateLoader)
-    indexTemplate  = templates.get_template(cfg.templates['index'])
-    pageEnv        = { 'posts': [],
-                       'title': cfg.title,
-                     }
-    frontpageKeys = frontpage.keys()
-    frontpageKeys.sort(reverse=True)
+                        targetFile               = os.path.join(path, filename)
+                        page                     = loadMetadata(targetFile)
+                        posts[targetFile]        = int(page['key'])
+                        fingerprints[targetFile] = page.get('fingerprint', '')
+    pipe = db.pipeline()
+    pipe.delete(db.key(indexKey), db.key(fingerprintKey), db.key(archiveState))
+    if len(posts) > 0:
+        pipe.zadd(db.key(indexKey), posts)
+        pipe.hmset(db.key(fingerprintKey), fingerprints)
+    pipe.execute()
+    logger.info('post index rebuilt with %d posts' % len(posts))
+
+def indexUpdate(force=False):
+    """Generate the index page from the most recent posts in the post index
+    and then any archive pages that have changed.
+
+    The post index is rebuilt if it is missing.
+    """
+    logger.info('building index page')
+    with workLock('index'):
+        if not db.exists(db.key(indexKey)):
+            rebuildIndex()
+        indexTemplate  = getTemplates().get_template(cfg.templates['index'])
+        pageEnv        = { 'posts': [],
+                           'title': cfg.title,
+                         }
+
+        for targetFile, score in db.zrevrange(db.key(indexKey), 0, cfg.index_articles - 1, withscores=True):
+            if os.path.exists('%s.md' % targetFile):
+                pageEnv['posts'].append(loadMetadata(targetFile))
+            else:
+                logger.info('removing missing post [%s] from the index' % targetFile)
+                pipe = db.pipeline()
+                pipe.zrem(db.key(indexKey), targetFile)
+                pipe.hdel(db.key(fingerprintKey), targetFile)
+                pipe.sadd(db.key(archiveDirty), int(score))
+                pipe.execute()
+
+        page     = indexTemplate.render(pageEnv)
+        indexDir = os.path.join(cfg.paths.output)
+
+        if not os.path.exists(indexDir):
+            mkpath(indexDir)
+        writeFile(os.path.join(indexDir, 'index.html'), page.encode('utf-8'))
+
+        archiveUpdate(force)
+        feedUpdate(force)
+
+def archiveDay(score):
+    """Return the year and day of year of a post from its score in the post index.
+    """
+    created = datetime.datetime.strptime(str(int(score))[:8], '%Y%m%d')
+    return created.strftime('%Y'), created.strftime('%j')
+
+def archiveRange(year, doy=None):
+    """Return the lowest and highest post index score of a year or a day of year.
+    """
+    if doy is None:
+        return int('%s0101000000' % year), int('%s1231235959' % year)
+    day = datetime.datetime.strptime('%s %s' % (year, doy), '%Y %j').strftime('%Y%m%d')
+    return int('%s000000' % day), int('%s235959' % day)
+
+def archivePages(count, numbers, groups):
+    """Read the posts of a set of archive pages from the post index.
+
+    count:   the number of numbered pages
+    numbers: the numbered pages to read
+    groups:  the (year, doy) pages to read, doy is None for a year page
+
+    Numbered pages hold archive_articles posts each and are numbered from
+    the oldest post so that a new post only changes the newest page. The
+    year and day pages hold the posts created in that year or day.
+
+    Returns a dict of page filename, relative to the output path, to the
+    page's archive details and its targetFiles ordered newest first.
+    """
+    pageSize = cfgOption('archive_articles', cfg.index_articles)
+    pages    = []
+    pipe     = db.pipeline()
+    for n in numbers:
+        archive = { 'type':  'page',
+                    'page':  n,
+                    'older': n - 1 if n > 1 else None,
+                    'newer': n + 1 if n < count else None,
+                  }
+        pages.append((os.path.join('page', str(n), 'index.html'), archive))
+        pipe.zrange(db.key(indexKey), (n - 1) * pageSize, n * pageSize - 1)
+    for year, doy in groups:
+        if doy is None:
+            pages.append((os.path.join(year, 'index.html'), { 'type': 'year', 'year': year }))
+        else:
+            pages.append((os.path.join(year, doy, 'index.html'), { 'type': 'day', 'year': year, 'doy': doy }))
+        low, high = archiveRange(year, doy)
+        pipe.zrevrangebyscore(db.key(indexKey), high, low)
+    result = {}
+    for (filename, archive), posts in zip(pages, pipe.execute()):
+        if archive['type'] == 'page':
+            posts = posts[::-1]
+        result[filename] = (archive, posts)
+    return result
+
+def archiveUpdate(force=False):
+    """Generate the archive pages whose posts have changed.
+
+    Only the pages affected by the posts indexed since the last update are
+    considered: the numbered pages from the one holding the oldest changed
+    post onwards, as adding or removing a post moves every newer post, and
+    the year and day pages of the changed posts. Every page is considered
+    when force is True or the templates or site config have changed.
+
+    Each archive page has a fingerprint made from its archive details, the
+    render fingerprints of its posts and the templates. Only pages with a
+    changed fingerprint, or that are missing, are generated. Pages that
+    no longer have any posts are removed.
 
-    for key in frontpageKeys[:cfg.index_articles]:
-        pageEnv['posts'].append(frontpage[key])
+    Must be called while holding the index lock.
+    """
+    pageSize = cfgOption('archive_articles', cfg.index_articles)
+    template = getTemplates().get_template(cfg.templates.get('archive', cfg.templates['index']))
+    stamp    = templateStamp()
+    h        = hashlib.sha1()
+    h.update(json.dumps([cfg.title, cfg.baseroute, pageSize]))
+    h.update(stamp)
+    siteStamp = h.hexdigest()
+
+    pipe = db.pipeline()
+    pipe.smembers(db.key(archiveDirty))
+    pipe.delete(db.key(archiveDirty))
+    pipe.zcard(db.key(indexKey))
+    pipe.hgetall(db.key(archiveState))
+    dirty, cleared, total, state = pipe.execute()
+    try:
+        count    = (total + pageSize - 1) // pageSize
+        previous = int(state.get('pages', 0))
+        full     = force or state.get('stamp') != siteStamp
+        groups   = set()
+        if full:
+            numbers = range(1, count + 1)
+            scores  = [score for targetFile, score in db.zrange(db.key(indexKey), 0, -1, withscores=True)]
+        else:
+            start = count + 1
+            if previous != count:
+                for n in (previous, count):
+                    if n > 0:
+                        start = min(start, n)
+            scores = [int(score) for score in dirty]
+            if len(scores) > 0:
+                pipe = db.pipeline()
+                for score in scores:
+                    pipe.zcount(db.key(indexKey), '-inf', '(%d' % score)
+                for rank in pipe.execute():
+                    start = min(start, rank // pageSize + 1)
+            numbers = range(start, count + 1)
+        for score in scores:
+            year, doy = archiveDay(score)
+            groups.add((year, None))
+            groups.add((year, doy))
+
+        pages = archivePages(count, numbers, groups)
+        stale = [os.path.join('page', str(n), 'index.html') for n in range(count + 1, previous + 1)]
+        for filename in pages.keys():
+            if len(pages[filename][1]) == 0:
+                stale.append(filename)
+                del pages[filename]
+        if full:
+            for filename in db.hkeys(db.key(archiveKey)):
+                if filename not in pages and filename not in stale:
+                    stale.append(filename)
+
+        members      = list(set([targetFile for archive, posts in pages.values() for targetFile in posts]))
+        filenames    = list(pages.keys())
+        fingerprints = {}
+        current      = {}
+        pipe         = db.pipeline()
+        if len(members) > 0:
+            pipe.hmget(db.key(fingerprintKey), members)
+        if len(filenames) > 0:
+            pipe.hmget(db.key(archiveKey), filenames)
+        results = pipe.execute()
+        if len(members) > 0:
+            fingerprints = dict(zip(members, results.pop(0)))
+        if len(filenames) > 0:
+            current = dict(zip(filenames, results.pop(0)))
+
+        pipe      = db.pipeline()
+        generated = 0
+        for filename in pages:
+            archive, posts = pages[filename]
+            h = hashlib.sha1()
+            h.update(json.dumps([archive, cfg.title, cfg.baseroute], sort_keys=True))
+            h.update(stamp)
+            for targetFile in posts:
+                h.update('%s %s' % (targetFile, fingerprints.get(targetFile) or ''))
+            fingerprint = h.hexdigest()
+            pageFile    = os.path.join(cfg.paths.output, filename)
+
+            if not force and current.get(filename) == fingerprint and os.path.exists(pageFile):
+                continue
+
+            pageEnv = { 'posts':   [],
+                        'title':   cfg.title,
+                        'archive': archive,
+                      }
+            for targetFile in posts:
+                if os.path.exists('%s.md' % targetFile):
+                    pageEnv['posts'].append(loadMetadata(targetFile))
+            pageDir = os.path.dirname(pageFile)
+            if not os.path.exists(pageDir):
+                mkpath(pageDir)
+            writeFile(pageFile, template.render(pageEnv).encode('utf-8'))
+            pipe.hset(db.key(archiveKey), filename, fingerprint)
+            generated += 1
+
+        for filename in stale:
+            logger.info('removing empty archive page [%s]' % filename)
+            pageFile = os.path.join(cfg.paths.output, filename)
+            if os.path.exists(pageFile):
+                os.remove(pageFile)
+            pipe.hdel(db.key(archiveKey), filename)
+        pipe.hmset(db.key(archiveState), { 'pages': count, 'stamp': siteStamp })
+        pipe.execute()
+    except:
+        if len(dirty) > 0:
+            db.sadd(db.key(archiveDirty), *dirty)
+        raise
+    logger.info('generated %d of %d archive pages' % (generated, len(pages)))
+
+def feedDate(value):
+    """Return a timezone aware datetime for a post date.
+
+    Dates without a timezone are UTC, the stored post timestamps are
+    taken from utcnow() and saved without their offset.
+    """
+    if value.tzinfo is None:
+        value = pytz.utc.localize(value)
+    return value
+
+def feedUpdate(force=False):
+    """Generate the Atom and JSON feeds from the most recent posts in the post index.
 
-    page     = indexTemplate.render(pageEnv)
-    indexDir = os.path.join(cfg.paths.output)
+    The feeds are only generated when the feed fingerprint, made from the
+    render fingerprints of the posts in the feed, the templates and the
+    site config, has changed. Entries use the escaped post html saved
+    by postUpdate().
 
-    if not os.path.exists(indexDir):
-        mkpath(indexDir)
-    with open(os.path.join(indexDir, 'index.html'), 'w+') as h:
-        h.write(page.encode('utf-8'))
+    Must be called while holding the index lock.
+    """
+    members  = db.zrevrange(db.key(indexKey), 0, cfgOption('feed_articles', cfg.index_articles) - 1)
+    atomURL  = '%s%s%s' % (cfg.baseurl, cfg.baseroute, cfgOption('feed_atom', 'atom.xml'))
+    jsonURL  = '%s%s%s' % (cfg.baseurl, cfg.baseroute, cfgOption('feed_json', 'feed.json'))
+    atomFile = os.path.join(cfg.paths.output, cfgOption('feed_atom', 'atom.xml'))
+    jsonFile = os.path.join(cfg.paths.output, cfgOption('feed_json', 'feed.json'))
+
+    h = hashlib.sha1()
+    h.update(json.dumps([cfg.title, cfg.baseurl, cfg.baseroute, atomURL, jsonURL]))
+    h.update(templateStamp())
+    if len(members) > 0:
+        for targetFile, fingerprint in zip(members, db.hmget(db.key(fingerprintKey), members)):
+            h.update('%s %s' % (targetFile, fingerprint or ''))
+    fingerprint = h.hexdigest()
+
+    if not force and db.get(db.key(feedKey)) == fingerprint and os.path.exists(atomFile) and os.path.exists(jsonFile):
+        return
+
+    logger.info('building feeds')
+    posts   = []
+    updates = []
+    for targetFile in members:
+        if os.path.exists('%s.md' % targetFile):
+            post = loadMetadata(targetFile)
+            if 'xml' not in post:
+                logger.info('skipping post [%s] that has not been generated' % targetFile)
+                continue
+            published = feedDate(post['published'])
+            updated   = feedDate(post.get('updated', post['published']))
+            post['link']          = '%s%s' % (cfg.baseurl, post['url'])
+            post['authorName']    = post.get('author', cfg.title)
+            post['publishedDate'] = published.isoformat()
+            post['updatedDate']   = updated.isoformat()
+            posts.append(post)
+            updates.append(updated)
+
+    if len(updates) > 0:
+        updated = max(updates).isoformat()
+    else:
+        updated = datetime.datetime.now(pytz.utc).replace(microsecond=0).isoformat()
+    pageEnv = { 'posts':   posts,
+                'title':   cfg.title,
+                'siteURL': '%s%s' % (cfg.baseurl, cfg.baseroute),
+                'feedURL': atomURL,
+                'updated': updated,
+              }
+    jsonFeed = { 'version':       'https://jsonfeed.org/version/1',
+                 'title':         cfg.title,
+                 'home_page_url': pageEnv['siteURL'],
+                 'feed_url':      jsonURL,
+                 'items':         [],
+               }
+    for post in posts:
+        jsonFeed['items'].append({ 'id':             post['link'],
+                                   'url':            post['link'],
+                                   'title':          post['title'],
+                                   'summary':        post.get('summary', ''),
+                                   'content_html':   post['html'],
+                                   'date_published': post['publishedDate'],
+                                   'date_modified':  post['updatedDate'],
+                                   'author':         { 'name': post['authorName'] },
+                                 })
+
+    if not os.path.exists(cfg.paths.output):
+        mkpath(cfg.paths.output)
+    writeFile(atomFile, getAtomTemplate().render(pageEnv).encode('utf-8'))
+    writeFile(jsonFile, json.dumps(jsonFeed, indent=2))
+    db.set(db.key(feedKey), fingerprint)
 
 def isUpdated(path, filename, force=False):
     mFile = os.path.join(path, '%s.md' % filename)
@@ -483,60 +1462,250 @@ def isUpdated(path, filename, force=False):
     else:
         return 'create'
 
+def fileHash(filename):
+    with open(filename, 'rb') as h:
+        return hashlib.sha1(h.read()).hexdigest()
+
+def scanContent(filepath):
+    """Yield targetFile, stat result and deleted flag for every
+    markdown file found below filepath.
+
+    Each directory is listed only once, the presence of the .deleted
+    file for a post is taken from that listing.
+    """
+    dirs = [filepath]
+    while len(dirs) > 0:
+        path    = dirs.pop()
+        names   = set()
+        entries = []
+        for entry in scandir(path):
+            if entry.is_dir():
+                dirs.append(entry.path)
+            else:
+                names.add(entry.name)
+                if entry.name.endswith('.md'):
+                    entries.append(entry)
+        for entry in entries:
+            filename = entry.name[:-3]
+            yield entry.path[:-3], entry.stat(), '%s.deleted' % filename in names
+
+def manifestCheck(targetFile, st, deleted, item, force=False):
+    """Compare a post with its manifest entry.
+
+    The markdown file is only read, to compare content hashes, when its
+    mtime or size differ from the manifest. Posts not yet in the manifest
+    are checked against their .json sidecar using isUpdated().
+
+    Returns the event action, or None if the post is unchanged, and the
+    new manifest entry or None if the entry is unchanged.
+    """
+    action = None
+    entry  = { 'mtime':   st.st_mtime,
+               'size':    st.st_size,
+               'deleted': deleted,
+             }
+    if item is None:
+        path, filename = os.path.split(targetFile)
+        action         = isUpdated(path, filename, force)
+        if action == 'unchanged':
+            action = None
+        entry['hash'] = fileHash('%s.md' % targetFile)
+        return action, entry
+
+    if item['mtime'] == entry['mtime'] and item['size'] == entry['size']:
+        entry['hash'] = item['hash']
+    else:
+        entry['hash'] = fileHash('%s.md' % targetFile)
+    if force or deleted != item['deleted'] or entry['hash'] != item['hash']:
+        if deleted:
+            action = 'delete'
+        else:
+            action = 'update'
+    if entry == item:
+        entry = None
+    return action, entry
+
 def gather(filepath, filename=None, force=False):
+    """Check posts against the manifest and publish events for any changes.
+
+    The manifest holds the mtime, size, content hash and deleted flag of
+    every post so unchanged posts do not generate any events. Manifest
+    updates and events are sent in transactions of gather_batch posts.
+
+    The manifest entry of a changed post is carried by its event and only
+    saved once the post has been generated, so a post that fails to
+    generate is gathered again by the next scan. When force is True every
+    post found is published as an update that is generated even if its
+    render fingerprint is unchanged.
+    """
     logger.info('gather [%s] [%s] [%s]' % (filepath, filename, force))
+    found   = []
+    changes = []
     if filename is None:
         if filepath is None:
             logger.error('A specific file or a path to walk must be specified')
         else:
-            for path, dirlist, filelist in os.walk(filepath):
-                if len(filelist) > 0:
-                    for item in filelist:
-                        filename, ext = os.path.splitext(item)
-                        if ext in ('.md',):
-                            state = isUpdated(path, filename, force)
-                            key   = 'kaku-event::%s::%s::%s' % ('post', state, str(uuid.uuid4()))
-                            data  = { 'type':   'post',
-                                      'action': state,
-                                      'data':   { 'path': path,
-                                                  'file': filename
-                                                },
-                                      'key':    key
-                                    }
-                            db.set(key, json.dumps(data))
-                            db.publish(cfg.events, key)
+            manifest = {}
+            for targetFile, item in db.hgetall(db.key(manifestKey)).items():
+                manifest[targetFile] = json.loads(item)
+            for targetFile, st, deleted in scanContent(filepath):
+                found.append(targetFile)
+                action, entry = manifestCheck(targetFile, st, deleted, manifest.pop(targetFile, None), force)
+                if action is not None or entry is not None:
+                    changes.append((targetFile, action, entry))
+            # forget any posts whose markdown file has been removed
+            removed = [targetFile for targetFile in manifest if targetFile.startswith(filepath)]
+            if len(removed) > 0:
+                db.hdel(db.key(manifestKey), *removed)
     else:
         s = normalizeFilename(filename)
         if not os.path.exists(s):
             s = normalizeFilename(os.path.join(filepath, filename))
         logger.info('checking [%s]' % s)
         if os.path.exists(s):
-            path          = os.path.dirname(s)
-            filename, ext = os.path.splitext(s)
+            targetFile, ext = os.path.splitext(s)
             if ext in ('.md',):
-                state = isUpdated(path, filename, force)
-                key   = 'kaku-event::%s::%s::%s' % ('post', state, str(uuid.uuid4()))
-                data  = { 'type':   'post',
-                          'action': state,
-                          'data':   { 'path': path,
-                                      'file': filename
-                                    },
-                          'key':    key
-                        }
-                db.set(key, json.dumps(data))
-                db.publish(cfg.events, key)
-
-def handlePost(eventAction, eventData):
+                found.append(targetFile)
+                item = db.hget(db.key(manifestKey), targetFile)
+                if item is not None:
+                    item = json.loads(item)
+                action, entry = manifestCheck(targetFile, os.stat(s),
+                                              os.path.exists('%s.deleted' % targetFile),
+                                              item, force)
+                if action is not None or entry is not None:
+                    changes.append((targetFile, action, entry))
+
+    published = 0
+    batchSize = cfgOption('gather_batch', 500)
+    for n in range(0, len(changes), batchSize):
+        entries = {}
+        events  = []
+        for targetFile, action, entry in changes[n:n + batchSize]:
+            if action is not None:
+                data = { 'path':     os.path.dirname(targetFile),
+                         'file':     targetFile,
+                         'manifest': entry,
+                       }
+                if force:
+                    data['force'] = True
+                events.append(('post', action, data))
+            elif entry is not None:
+                entries[targetFile] = json.dumps(entry)
+        pipe = db.pipeline()
+        if len(entries) > 0:
+            pipe.hmset(db.key(manifestKey), entries)
+        published += len(publishEvents(db, cfg.events, events, pipe, cfgOption('event_compress', 1024)))
+    logger.info('gather checked %d posts and published %d events' % (len(found), published))
+
+def watchContent(debounce, interval):
+    """Watch the content tree and gather posts as their files change.
+
+    Changes to .md and .deleted files are collected and a post is gathered
+    once no further changes to it have been seen for debounce seconds.
+    If pyinotify is not available the content tree is gathered every
+    interval seconds instead.
+    """
+    if pyinotify is None:
+        logger.info('pyinotify is not available, checking content every %s seconds' % interval)
+        while True:
+            gather(cfg.paths.content)
+            time.sleep(interval)
+
+    pending = {}
+
+    class ContentHandler(pyinotify.ProcessEvent):
+        def process_default(self, event):
+            if not event.dir:
+                targetFile, ext = os.path.splitext(event.pathname)
+                if ext in ('.md', '.deleted'):
+                    pending[targetFile] = time.time()
+
+    mask     = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM
+    manager  = pyinotify.WatchManager()
+    notifier = pyinotify.Notifier(manager, ContentHandler(), timeout=int(debounce * 500))
+    manager.add_watch(cfg.paths.content, mask, rec=True, auto_add=True)
+    logger.info('watching [%s] for changes' % cfg.paths.content)
+    while True:
+        if notifier.check_events():
+            notifier.read_events()
+            notifier.process_events()
+        now = time.time()
+        for targetFile in [item for item in pending if now - pending[item] >= debounce]:
+            del pending[targetFile]
+            gather(cfg.paths.content, '%s.md' % targetFile)
+
+def rebuildPost(targetFile):
+    """Generate a single post for rebuildAll(), run in a pool worker process.
+
+    Returns the targetFile, if it was generated without error, and the
+    stage timings and file write counts for the post.
+    """
+    resetTimings()
+    resetIOStats()
+    result = True
+    try:
+        with workLock(targetFile):
+            postUpdate(targetFile, force=True, outbound=False)
+    except:
+        logger.exception('error generating post [%s]' % targetFile)
+        result = False
+    return targetFile, result, stageTimings(), ioStats()
+
+def rebuildAll(workers):
+    """Generate every post using a pool of worker processes.
+
+    Outbound Webmentions are not sent. The post index and the index
+    page are rebuilt once all posts are done and the throughput and
+    time spent in each stage are reported.
+    """
+    start   = time.time()
+    posts   = [targetFile for targetFile, st, deleted in scanContent(cfg.paths.content)]
+    errors  = 0
+    timings = {}
+    io      = {}
+    logger.info('rebuilding %d posts with %d workers' % (len(posts), workers))
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for targetFile, result, postTimings, postIO in pool.imap_unordered(rebuildPost, posts, chunksize=8):
+            if not result:
+                errors += 1
+            for stage in postTimings:
+                timings[stage] = timings.get(stage, 0.0) + postTimings[stage]
+            for item in postIO:
+                io[item] = io.get(item, 0) + postIO[item]
+    finally:
+        pool.close()
+        pool.join()
+
+    resetTimings()
+    with timed('index'):
+        rebuildIndex()
+        indexUpdate(force=True)
+    timings['index'] = stageTimings()['index']
+
+    elapsed = time.time() - start
+    logger.info('rebuilt %d posts (%d errors) in %0.2f seconds, %0.1f posts per second' %
+                (len(posts), errors, elapsed, len(posts) / max(elapsed, 0.001)))
+    for stage in ('load', 'markdown', 'render', 'write', 'index'):
+        logger.info('    %-8s %8.2f seconds' % (stage, timings.get(stage, 0.0)))
+    if len(io) > 0:
+        logger.info('    wrote %(written)d files (%(bytesWritten)d bytes), '
+                    'skipped %(skipped)d unchanged files (%(bytesSkipped)d bytes)' % io)
+
+def handlePost(eventAction, eventData, batch):
     """Process the Kaku event for Posts.
 
     eventAction: create, update, delete, undelete or unchanged
     eventData:   a dict that contains information about the post
+    batch:       the RenderBatch the post is added to
 
     Micropub generated post events will have eventData keys:
         slug, title, location, timestamp, micropub
 
     Post events generated by the gather daemon will have keys:
-        path, file
+        path, file, manifest and force if the post is to be generated
+        even when it is unchanged
     """
     if eventAction == 'create':
         if 'path' in eventData:
@@ -551,39 +1720,75 @@ def handlePost(eventAction, eventData):
             targetFile = os.path.join(postDir, slug)
             if not os.path.exists(postDir):
                 mkpath(postDir)
-        checkPost(targetFile, eventData)
-        postUpdate(targetFile, eventAction)
+        with workLock(targetFile):
+            checkPost(targetFile, eventData)
+        batch.add(targetFile, eventAction, eventData.get('manifest'), eventData.get('force', False))
     elif eventAction in ('update', 'delete'):
         if 'file' in eventData:
             targetFile = eventData['file']
         else:
-            targetURL   = urlparse(eventData['url'])
-            targetRoute = targetURL.path.replace(cfg.baseroute, '')
-            targetFile  = os.path.join(cfg.paths.content, targetRoute[1:])
-            with open('%s.deleted' % targetFile, 'a'):
-                os.utime('%s.deleted' % targetFile, None)
-        postUpdate(targetFile, eventAction)
+            targetFile = os.path.join(cfg.paths.content, targetRoute(eventData['url'], cfg.baseroute))
+            with workLock(targetFile):
+                with open('%s.deleted' % targetFile, 'a'):
+                    os.utime('%s.deleted' % targetFile, None)
+        batch.add(targetFile, eventAction, eventData.get('manifest'), eventData.get('force', False))
     elif eventAction == 'undelete':
         if 'url' in eventData:
-            targetURL   = urlparse(eventData['url'])
-            targetRoute = targetURL.path.replace(cfg.baseroute, '')
-            targetFile  = os.path.join(cfg.paths.content, targetRoute[1:])
-            if os.path.exists('%s.deleted' % targetFile):
-                os.remove('%s.deleted' % targetFile)
-                postUpdate(targetFile, eventAction)
-    indexUpdate()
-
-def handleMentions(eventAction, eventData):
+            targetFile = os.path.join(cfg.paths.content, targetRoute(eventData['url'], cfg.baseroute))
+            with workLock(targetFile):
+                if os.path.exists('%s.deleted' % targetFile):
+                    os.remove('%s.deleted' % targetFile)
+                    batch.add(targetFile, eventAction)
+    batch.index = True
+
+def mentionVerify(eventData, batch):
+    """Verify a Webmention queued by the Webmention endpoint.
+
+    A verified mention is added to, or for a deleted source removed from,
+    the target post and the Webmention's status is updated.
+    """
+    statusTTL = cfgOption('webmention_status_ttl', 604800)
+    mentionId = eventData['id']
+    if resolveTarget(db, eventData['targetURL'], cfg.baseroute, cfg.paths.content,
+                     cfgOption('target_cache_ttl', 3600)) != 200:
+        setMentionStatus(db, mentionId, 'rejected', 'target was not found', statusTTL)
+        return
+    try:
+        status, detail, mention = verifyMention(db, eventData['sourceURL'], eventData['targetURL'],
+                                                eventData.get('vouchDomain'), eventData.get('vouchRequired', False),
+                                                cfg.paths.content,
+                                                cfgOption('discovery_ttl', 86400),
+                                                cfgOption('discovery_negative_ttl', 3600),
+                                                cfgOption('discovery_timeout', 10))
+    except (ValueError, requests.exceptions.RequestException):
+        logger.exception('exception verifying Webmention [%s]' % mentionId)
+        setMentionStatus(db, mentionId, 'rejected', 'source could not be retrieved', statusTTL)
+        return
+    logger.info('Webmention [%s] from [%s] %s: %s' % (mentionId, eventData['sourceURL'], status, detail))
+    if status == 'accepted':
+        mentionUpdate(mention, batch)
+    elif status == 'deleted':
+        mentionDelete(mention, batch)
+    setMentionStatus(db, mentionId, status, detail, statusTTL)
+
+def handleMentions(eventAction, eventData, batch):
     """Process the Kaku event for mentions.
 
-    eventAction: create, update or delete
-    eventData:   dict with the keys sourceURL, targetURL,
-                 vouchDomain, vouched, postDate, hcard, mf2data
+    eventAction: verify, create, update or delete
+    eventData:   for verify a dict with the keys id, sourceURL, targetURL,
+                 vouchDomain and vouchRequired, otherwise a dict with the
+                 keys sourceURL, targetURL, vouchDomain, vouched,
+                 postDate, hcard and mf2, the digest of the source's mf2
+                 data in the blob store. An mf2data item holding the mf2
+                 data itself is moved to the blob store.
+    batch:       the RenderBatch the mentioned post is added to
     """
-    if eventAction == 'create' or eventAction == 'update':
-        mentionUpdate(eventData)
+    if eventAction == 'verify':
+        mentionVerify(eventData, batch)
+    elif eventAction == 'create' or eventAction == 'update':
+        mentionUpdate(eventData, batch)
     elif eventAction == 'delete':
-        mentionDelete(eventData)
+        mentionDelete(eventData, batch)
 
 def handleGather(eventData):
     if 'file' in eventData:
@@ -591,11 +1796,40 @@ def handleGather(eventData):
     else:
         gather(cfg.paths.content)
 
-def handleEvent(eventKey):
+def retryEvent(eventKey):
+    """Fail an event so that it is retried, first after event_retry_delay
+    seconds, until it has failed event_retries times and is then moved to
+    the dead-letter list.
+
+    The status of a Webmention whose verify event failed is updated, to
+    error once the event has been moved to the dead-letter list.
+    """
+    retried = failEvent(db, cfg.events, eventKey, cfgOption('event_retries', 3),
+                        cfgOption('event_dead_ttl', 604800), cfgOption('event_dead_max', 1000),
+                        cfgOption('event_retry_delay', 60))
+    if retried:
+        logger.info('event [%s] will be retried' % eventKey)
+    else:
+        logger.error('event [%s] has been moved to the dead-letter list' % eventKey)
+    try:
+        event = loadEvent(db, eventKey)
+        if event is not None and event['type'] == 'mention' and event['action'] == 'verify':
+            statusTTL = cfgOption('webmention_status_ttl', 604800)
+            if retried:
+                setMentionStatus(db, event['data']['id'], 'queued', 'verification failed, it will be retried', statusTTL)
+            else:
+                setMentionStatus(db, event['data']['id'], 'error', 'verification failed', statusTTL)
+    except:
+        logger.exception('unable to update the status of event [%s]' % eventKey)
+
+def handleEvent(eventKey, batch=None):
     """Process an incoming Kaku Event.
 
     Retrieve the event data from the key given and call the appropriate handler.
 
+    Posts affected by the event are added to batch and generated by the caller
+    with renderBatch(). If no batch is given they are generated before returning.
+
     Valid Event Types are mention, post, gather
 
     For gather events, only the data item will be found
@@ -603,9 +1837,20 @@ def handleEvent(eventKey):
 
     Valid Event Action are create, update, delete, undelete
     Event Data is a dict of items relevant to the event
+
+    The event is completed by renderBatch() once its posts have been
+    generated, its payload then expires after event_ttl seconds. An
+    event that fails, or whose posts fail to generate, is retried.
     """
+    render = batch is None
+    if render:
+        batch = RenderBatch()
+    batch.event = eventKey
     try:
-        event     = json.loads(db.get(eventKey))
+        event = loadEvent(db, eventKey)
+        if event is None:
+            logger.info('event [%s] has expired, dropping it' % eventKey)
+            return
         eventType = event['type']
 
         if eventType == 'gather':
@@ -615,12 +1860,147 @@ def handleEvent(eventKey):
             eventData   = event['data']
             logger.info('dispatching %(action)s for %(type)s' % event)
             if eventType == 'post':
-                handlePost(eventAction, eventData)
+                handlePost(eventAction, eventData, batch)
             elif eventType == 'mention':
-                handleMentions(eventAction, eventData)
-        db.expire(eventKey, 86400)
+                handleMentions(eventAction, eventData, batch)
+        batch.handled.append(eventKey)
     except:
         logger.exception('error during event [%s]' % eventKey)
+        retryEvent(eventKey)
+    finally:
+        batch.event = None
+    if render:
+        renderBatch(batch)
+
+def heartbeat(consumers, timeout, stopped):
+    """Keep the heartbeat of each consumer alive until stopped is set.
+    """
+    while not stopped.is_set():
+        for consumer in consumers:
+            try:
+                registerConsumer(db, cfg.events, consumer, timeout)
+            except:
+                logger.exception('[%s] exception during heartbeat' % consumer)
+        stopped.wait(timeout / 3.0)
+
+def eventLoop(consumer, timeout):
+    """Claim and handle events from the event queue.
+
+    After an event arrives any further events claimed within the
+    coalesce_window (1 second by default, up to coalesce_max events)
+    are handled with it as a batch. Each post affected by the batch is
+    generated once and the index page at most once, after which the
+    events are acknowledged.
+
+    Events held by consumers whose heartbeat has stopped are returned
+    to the queue every timeout seconds so that any other running
+    consumer can pick them up. Failed events that are due to be retried
+    are returned to the queue after each batch.
+
+    An error, for example from Redis, is logged and the loop carries on
+    after a delay that doubles up to error_backoff_max seconds (60 by
+    default). Any events the consumer still holds are then returned to
+    the queue, as its heartbeat keeps other consumers from reclaiming them.
+    """
+    window      = cfgOption('coalesce_window', 1.0)
+    maxKeys     = cfgOption('coalesce_max', 100)
+    backoffMax  = cfgOption('error_backoff_max', 60)
+    backoff     = 0
+    reclaim     = True
+    lastReclaim = time.time()
+    logger.info('[%s] listening for events' % consumer)
+    while True:
+        try:
+            if reclaim:
+                logger.info('[%s] reclaimed %d events' % (consumer, reclaimEvents(db, cfg.events, consumer)))
+                reclaim = False
+            key = claimEvent(db, cfg.events, consumer)
+            if key is not None:
+                keys     = []
+                batch    = RenderBatch()
+                deadline = time.time() + window
+                resetIOStats()
+                db.resetRoundTrips()
+                while key is not None or (time.time() < deadline and len(keys) < maxKeys):
+                    if key is None:
+                        time.sleep(0.05)
+                    else:
+                        keys.append(key)
+                        if key.startswith(db.key('kaku-event::')):
+                            logger.info('handling event [%s]' % key)
+                            handleEvent(key, batch)
+                    if len(keys) < maxKeys:
+                        key = claimEvent(db, cfg.events, consumer, 0)
+                    else:
+                        key = None
+                logger.info('[%s] generating %d posts for %d events' % (consumer, len(batch.posts), len(keys)))
+                renderBatch(batch)
+                pipe = db.pipeline()
+                for key in keys:
+                    ackEvent(pipe, cfg.events, consumer, key)
+                pipe.execute()
+                stats = dict(ioStats(), consumer=consumer, roundTrips=db.roundTrips())
+                logger.info('[%(consumer)s] wrote %(written)d files (%(bytesWritten)d bytes), '
+                            'skipped %(skipped)d unchanged files (%(bytesSkipped)d bytes), '
+                            '%(roundTrips)d redis round trips' % stats)
+            n = retryEvents(db, cfg.events)
+            if n > 0:
+                logger.info('[%s] returned %d failed events to be retried' % (consumer, n))
+            if time.time() - lastReclaim > timeout:
+                n = reclaimEvents(db, cfg.events)
+                if n > 0:
+                    logger.info('[%s] reclaimed %d events from stopped consumers' % (consumer, n))
+                lastReclaim = time.time()
+            backoff = 0
+        except Exception:
+            backoff = min(max(backoff * 2, 1), backoffMax)
+            reclaim = True
+            logger.exception('[%s] exception in event loop, retrying in %d seconds' % (consumer, backoff))
+            time.sleep(backoff)
+
+def runWorker(consumer, timeout):
+    """Start the heartbeat for the consumer and then handle events.
+
+    The heartbeat is stopped if the event loop exits, so that the events
+    the consumer holds can be reclaimed by the other consumers.
+    """
+    stopped = threading.Event()
+    registerConsumer(db, cfg.events, consumer, timeout)
+    t = threading.Thread(target=heartbeat, args=([consumer], timeout, stopped))
+    t.daemon = True
+    t.start()
+    try:
+        eventLoop(consumer, timeout)
+    finally:
+        stopped.set()
+        logger.error('[%s] event loop stopped' % consumer)
+
+def startSweeper():
+    interval = cfgOption('sweep_interval', 60)
+    if interval > 0:
+        t = threading.Thread(target=sweeper, args=(interval,))
+        t.daemon = True
+        t.start()
+
+def startWorkers(consumer, workers, workerType, timeout):
+    """Start a pool of event workers, each claiming events as its own consumer.
+
+    workerType: thread or process
+
+    Returns the started workers.
+    """
+    logger.info('starting %d %s workers' % (workers, workerType))
+    pool = []
+    for n in range(workers):
+        args = ('%s-%d' % (consumer, n), timeout)
+        if workerType == 'process':
+            w = multiprocessing.Process(target=runWorker, args=args)
+        else:
+            w = threading.Thread(target=runWorker, args=args)
+        w.daemon = True
+        w.start()
+        pool.append(w)
+    return pool
 
 def initLogging(logpath, logname):
     logFormatter = logging.Formatter("%(asctime)s %(levelname)-9s %(message)s", "%Y-%m-%d %H:%M:%S")
@@ -630,29 +2010,71 @@ def initLogging(logpath, logname):
     logger.addHandler(logHandler)
     logger.setLevel(logging.DEBUG)
 
+    # the shared kaku modules log to the same file
+    kakuLogger = logging.getLogger('kaku')
+    kakuLogger.addHandler(logHandler)
+    kakuLogger.setLevel(logging.DEBUG)
+
 def getRedis(redisURL):
-    url  = urlparse(redisURL)
-    host = url.netloc
-    if ':' in host:
-        host, port = host.split(':')
-        port       = int(port)
-    else:
-        port = 6379
-    if len(url.path) > 0:
-        db = int(url.path[1:])
+    """Return the Redis client shared by all of the worker threads.
+
+    Keys are namespaced with the key_base config item, which must match
+    the KEY_BASE setting of the Flask app.
+    """
+    maxConnections = cfgOption('redis_max_connections')
+    if maxConnections is None:
+        return KakuRedis.from_url(redisURL, keyBase=cfgOption('key_base', ''))
     else:
-        db = 0
-    return redis.StrictRedis(host=host, port=port, db=db)
+        return KakuRedis.from_url(redisURL, keyBase=cfgOption('key_base', ''), max_connections=maxConnections)
 
 # Example config file
 # {
 #     "baseroute":  "/bearlog/",
 #     "baseurl":    "https://bear.im",
 #     "index_articles": 15,
+#     "archive_articles": 15,
+#     "feed_articles": 15,
+#     "feed_atom": "atom.xml",
+#     "feed_json": "feed.json",
 #     "redis": "redis://127.0.0.1:6379/1",
+#     "redis_max_connections": 32,
+#     "key_base": "",
 #     "markdown_extras": [ "fenced-code-blocks", "cuddled-lists" ],
 #     "logname": "kaku_events.log",
 #     "events": "kaku-events",
+#     "consumer_timeout": 300,
+#     "workers": 4,
+#     "worker_type": "thread",
+#     "lock_timeout": 600,
+#     "fsync": "never",
+#     "coalesce_window": 1.0,
+#     "coalesce_max": 100,
+#     "error_backoff_max": 60,
+#     "template_cache": "/home/bearim/cache/templates/",
+#     "markdown_cache": "redis",
+#     "markdown_cache_size": 256,
+#     "markdown_cache_ttl": 604800,
+#     "gather_batch": 500,
+#     "event_ttl": 86400,
+#     "event_retries": 3,
+#     "event_retry_delay": 60,
+#     "event_dead_ttl": 604800,
+#     "event_dead_max": 1000,
+#     "event_compress": 1024,
+#     "watch_debounce": 0.5,
+#     "watch_interval": 5,
+#     "outbound_workers": 8,
+#     "outbound_per_host": 2,
+#     "discovery_ttl": 86400,
+#     "discovery_negative_ttl": 3600,
+#     "discovery_timeout": 10,
+#     "sweep_timeout": 10,
+#     "sweep_interval": 60,
+#     "mention_mf2": false,
+#     "webmention_status_ttl": 604800,
+#     "target_cache_ttl": 3600,
+#     "sweep_min_interval": 3600,
+#     "sweep_max_interval": 604800,
 #     "paths": {
 #         "templates": "/home/bearim/templates/",
 #         "content":   "/home/bearim/content/",
@@ -664,6 +2086,8 @@ def getRedis(redisURL):
 #         "mention":  "mention.jinja",
 #         "postPage": "article_page.jinja",
 #         "index":    "blog_index.jinja",
+#         "archive":  "blog_archive.jinja",
+#         "atom":     "atom.jinja",
 #         "markdown": "post.md",
 #         "embed":    "meta.embed"
 #     }
@@ -675,7 +2099,26 @@ if __name__ == '__main__':
     parser.add_argument('--file',   default=None,
                         help='A specific markdown file to check and then exit')
     parser.add_argument('--force',  default=False, action='store_true',
-                        help='Force any found markdown files (or specific file) to be considered an update.')
+                        help='Force any found markdown files (or specific file) to be considered an update and generated again.')
+    parser.add_argument('--rebuild-index', default=False, action='store_true',
+                        help='Rebuild the post index and the index page and then exit')
+    parser.add_argument('--rebuild-all', default=False, action='store_true',
+                        help='Generate every post and the index page, without sending Webmentions, and then exit')
+    parser.add_argument('--consumer', default=None,
+                        help='The name this daemon uses when claiming events, defaults to hostname-pid')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='The number of event workers to run, defaults to the workers config item or 1. '
+                             'For --rebuild-all the number of processes, defaults to the number of CPUs')
+    parser.add_argument('--worker-type', default=None, choices=('thread', 'process'),
+                        help='Run event workers as threads or processes, defaults to thread')
+    parser.add_argument('--sweep', default=False, action='store_true',
+                        help='Check any mentions that are due for a liveness check and then exit')
+    parser.add_argument('--replay-dead', default=False, action='store_true',
+                        help='Return the events in the dead-letter list to the event queue and then exit')
+    parser.add_argument('--migrate-mentions', default=False, action='store_true',
+                        help='Move the mentions in any .mentions files into the mention store and then exit')
+    parser.add_argument('--watch', default=False, action='store_true',
+                        help='Watch the content directory and gather any posts that change')
 
     args     = parser.parse_args()
     cfgFiles = findConfigFile(args.config)
@@ -692,17 +2135,46 @@ if __name__ == '__main__':
     with open(os.path.join(cfg.paths.templates, cfg.templates.embed)) as h:
         metaEmbed = h.read()
 
-    if args.file is not None:
+    if args.rebuild_index:
+        rebuildIndex()
+        indexUpdate()
+    elif args.rebuild_all:
+        if args.workers is None:
+            rebuildAll(multiprocessing.cpu_count())
+        else:
+            rebuildAll(args.workers)
+    elif args.sweep:
+        logger.info('checked %d mentions' % sweepMentions())
+    elif args.replay_dead:
+        replayed, expired = replayDeadEvents(db, cfg.events)
+        for eventKey in expired:
+            logger.warning('dead event [%s] has expired and was not replayed' % eventKey)
+        logger.info('replayed %d events, %d had expired' % (replayed, len(expired)))
+    elif args.migrate_mentions:
+        logger.info('migrated %d mentions' % migrateAllMentions())
+    elif args.watch:
+        watchContent(cfgOption('watch_debounce', 0.5), cfgOption('watch_interval', 5))
+    elif args.file is not None:
         gather(cfg.paths.content, args.file, args.force)
     else:
-        md = markdown2.Markdown(extras=cfg.markdown_extras)
-        p  = db.pubsub()
-
-        p.subscribe(cfg.events)
-        logger.info('listening for events')
-        for item in p.listen():
-            if item['type'] == 'message':
-                key = item['data']
-                if key.startswith('kaku-event::'):
-                    logger.info('handling event [%s]' % key)
-                    handleEvent(key)
+        timeout    = cfgOption('consumer_timeout', 300)
+        workers    = args.workers
+        workerType = args.worker_type
+        consumer   = args.consumer
+        if consumer is None:
+            consumer = '%s-%d' % (socket.gethostname(), os.getpid())
+        if workers is None:
+            workers = cfgOption('workers', 1)
+        if workerType is None:
+            workerType = cfgOption('worker_type', 'thread')
+
+        # the sweeper thread is started after any worker processes are
+        # forked so they do not inherit locks held by it
+        if workers > 1:
+            pool = startWorkers(consumer, workers, workerType, timeout)
+            startSweeper()
+            for w in pool:
+                w.join()
+        else:
+            startSweeper()
+            runWorker(consumer, timeout)
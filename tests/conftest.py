@@ -4,8 +4,25 @@
 :license: CC0 1.0 Universal, see LICENSE for more details.
 """
 
+import os
+import json
+
+import redis
 import pytest
+import fakeredis
+
 from kaku import create_app
+from kaku.store import KakuRedis
+from bearlib.config import Config
+
+import kaku_events
+
+templates = { 'article.jinja':      '<article>{{ post.html }}{% for m in mentions %}<m>{{ m.sourceURL }}</m>{% endfor %}</article>',
+              'article_page.jinja': '<html><title>{{ title }}</title>{{ post.html }}</html>',
+              'blog_index.jinja':   '{% for p in posts %}<li>{{ p.title }}</li>{% endfor %}',
+              'post.md':            'Title: %(title)s\nDate: %(created)s\nSlug: %(slug)s\nSummary: %(summary)s\n\n%(content)s\n',
+              'meta.embed':         '<meta name="title" content="%(title)s">',
+            }
 
 
 @pytest.yield_fixture
@@ -17,3 +34,55 @@ def app():
 def app_client(app):
     client = app.test_client()
     yield client
+
+@pytest.yield_fixture
+def db():
+    pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer())
+    yield KakuRedis(keyBase='test-', connection_pool=pool)
+
+@pytest.yield_fixture
+def site(tmpdir, db):
+    """Point the kaku_events daemon at a site in a temporary directory.
+    """
+    paths = {}
+    for name in ('templates', 'content', 'output', 'log'):
+        paths[name] = str(tmpdir.mkdir(name)) + '/'
+    for name in templates:
+        with open(os.path.join(paths['templates'], name), 'w') as h:
+            h.write(templates[name])
+    cfgFile = str(tmpdir.join('kaku_events.cfg'))
+    with open(cfgFile, 'w') as h:
+        json.dump({ 'baseroute':       '/bearlog/',
+                    'baseurl':         'https://bear.im',
+                    'title':           'bear.im',
+                    'index_articles':  3,
+                    'events':          'kaku-events',
+                    'markdown_extras': [],
+                    'paths':           paths,
+                    'templates':       { 'post':     'article.jinja',
+                                         'postPage': 'article_page.jinja',
+                                         'index':    'blog_index.jinja',
+                                         'markdown': 'post.md',
+                                         'embed':    'meta.embed',
+                                       },
+                  }, h)
+    cfg = Config()
+    cfg.fromJson(cfgFile)
+    kaku_events.cfg          = cfg
+    kaku_events.db           = db
+    kaku_events.mdPost       = templates['post.md']
+    kaku_events.metaEmbed    = templates['meta.embed']
+    kaku_events.templateEnv  = None
+    kaku_events.atomTemplate = None
+    kaku_events.mdCache.clear()
+    yield kaku_events
+
+def addPost(site, year, doy, slug, created, content='hello **world**'):
+    """Write a post's markdown file and return its targetFile.
+    """
+    postDir = os.path.join(site.cfg.paths.content, year, doy)
+    if not os.path.isdir(postDir):
+        os.makedirs(postDir)
+    with open(os.path.join(postDir, '%s.md' % slug), 'w') as h:
+        h.write('Title: %s\nDate: %s\nSlug: %s\nSummary: %s\n\n\n%s\n' % (slug, created, slug, slug, content))
+    return os.path.join(postDir, slug)
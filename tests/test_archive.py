@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+"""
+
+import os
+
+import mock
+import pytest
+
+from tests.conftest import addPost
+
+@pytest.yield_fixture
+def archive(site):
+    """A site with five posts, archived two to a page.
+    """
+    site.cfg['archive_articles'] = 2
+    posts = [ addPost(site, '2016', '123', 'one',   '2016-05-02 10:00:00'),
+              addPost(site, '2016', '123', 'two',   '2016-05-02 11:00:00'),
+              addPost(site, '2016', '124', 'three', '2016-05-03 10:00:00'),
+              addPost(site, '2017', '001', 'four',  '2017-01-01 10:00:00'),
+              addPost(site, '2017', '001', 'five',  '2017-01-01 11:00:00'),
+            ]
+    for targetFile in posts:
+        site.postUpdate(targetFile, outbound=False)
+    site.indexUpdate()
+    yield site, posts
+
+def archiveWrites(site, action):
+    """Return the archive pages written while running action.
+    """
+    with mock.patch.object(site, 'writeFile', wraps=site.writeFile) as writeFile:
+        action()
+    result = set()
+    for call in writeFile.call_args_list:
+        filename = os.path.relpath(call[0][0], site.cfg.paths.output)
+        if filename.endswith('index.html') and filename != 'index.html':
+            result.add(os.path.dirname(filename))
+    return result
+
+class TestArchivePages:
+    def test_partitions(self, archive):
+        """Numbered pages are filled from the oldest post, year and day pages by creation date
+        """
+        site, posts = archive
+        assert sorted(site.db.hkeys(site.db.key(site.archiveKey))) == \
+            ['2016/123/index.html', '2016/124/index.html', '2016/index.html',
+             '2017/001/index.html', '2017/index.html',
+             'page/1/index.html', 'page/2/index.html', 'page/3/index.html']
+        pages = site.archivePages(3, [1, 2, 3], [('2016', None), ('2016', '123')])
+        assert pages['page/1/index.html'] == ({ 'type': 'page', 'page': 1, 'older': None, 'newer': 2 }, [posts[1], posts[0]])
+        assert pages['page/3/index.html'] == ({ 'type': 'page', 'page': 3, 'older': 2, 'newer': None }, [posts[4]])
+        assert pages['2016/index.html'][1] == [posts[2], posts[1], posts[0]]
+        assert pages['2016/123/index.html'][1] == [posts[1], posts[0]]
+
+    def test_unchanged(self, archive):
+        """No archive page is generated when no post has changed
+        """
+        site, posts = archive
+        assert archiveWrites(site, site.indexUpdate) == set()
+
+    def test_new_post(self, archive):
+        """A new post only generates the newest page and the pages of its year and day
+        """
+        site, posts = archive
+        targetFile  = addPost(site, '2017', '002', 'six', '2017-01-02 10:00:00')
+        site.postUpdate(targetFile, outbound=False)
+        assert archiveWrites(site, site.indexUpdate) == set(['page/3', '2017', '2017/002'])
+
+    def test_deleted_post(self, archive):
+        """Removing the oldest post moves every numbered page and removes the emptied page
+        """
+        site, posts = archive
+        open('%s.deleted' % posts[0], 'w').close()
+        site.postUpdate(posts[0], 'delete', outbound=False)
+        assert archiveWrites(site, site.indexUpdate) == set(['page/1', 'page/2', '2016', '2016/123'])
+        assert not os.path.exists(os.path.join(site.cfg.paths.output, 'page', '3', 'index.html'))
+        assert 'page/3/index.html' not in site.db.hkeys(site.db.key(site.archiveKey))
+
+    def test_templates_changed(self, archive):
+        """Every archive page is considered again when the templates change
+        """
+        site, posts = archive
+        with mock.patch.object(site, 'templateStamp', return_value='changed'):
+            assert len(archiveWrites(site, site.indexUpdate)) == 8
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+"""
+
+from kaku.blobs import putBlob, getBlob, releaseBlob, blobKey
+from tests.conftest import addPost
+
+document = { 'items': [ { 'type': ['h-entry'], 'properties': { 'name': ['A reply'] } } ], 'rels': {} }
+
+class TestBlobs:
+    def test_roundtrip(self, db):
+        """A stored document is returned by its digest
+        """
+        digest = putBlob(db, document, 'a')
+        assert getBlob(db, digest) == document
+        assert getBlob(db, 'missing') is None
+
+    def test_dedup(self, db):
+        """The same document is stored once under the same digest
+        """
+        assert putBlob(db, document, 'a') == putBlob(db, dict(document), 'b')
+        assert len(db.keys(db.key('kaku-blob::*'))) == 1
+
+    def test_release(self, db):
+        """A document is deleted when its last reference is released
+        """
+        digest = putBlob(db, document, 'a')
+        putBlob(db, document, 'b')
+        assert not releaseBlob(db, digest, 'a')
+        assert not releaseBlob(db, digest, 'a')
+        assert db.exists(blobKey(db, digest))
+        assert releaseBlob(db, digest, 'b')
+        assert not db.exists(blobKey(db, digest))
+
+    def test_mention_delete(self, site):
+        """Removing a mention releases its mf2 data
+        """
+        targetFile = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        record     = { 'created': None,
+                       'updated': None,
+                       'mention': { 'sourceURL': 'http://example.com/reply', 'mf2data': document },
+                     }
+        site.saveOurMention(targetFile, 'mention::example.com::/reply', record)
+        digest = record['mention']['mf2']
+        assert site.db.exists(blobKey(site.db, digest))
+        assert site.deleteOurMention(targetFile, 'mention::example.com::/reply')
+        assert not site.db.exists(blobKey(site.db, digest))
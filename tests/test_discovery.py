@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+"""
+
+import mock
+import requests
+
+from kaku.discovery import cacheLifetime, discoverEndpoint
+
+def response(status=200, headers={}):
+    r = mock.Mock()
+    r.status_code = status
+    r.headers     = headers
+    return r
+
+class TestDiscovery:
+    def test_default_lifetime(self):
+        """Responses without cache headers are cached for the ttl
+        """
+        assert cacheLifetime({}, 3600) == 3600
+
+    def test_max_age(self):
+        """max-age is honoured but limited to the ttl
+        """
+        assert cacheLifetime({ 'cache-control': 'public, max-age=60' }, 3600) == 60
+        assert cacheLifetime({ 'cache-control': 'max-age=86400' }, 3600) == 3600
+
+    def test_no_store(self):
+        """Responses marked as not cacheable are not cached
+        """
+        assert cacheLifetime({ 'cache-control': 'no-store' }, 3600) == 0
+        assert cacheLifetime({ 'cache-control': 'no-cache, max-age=60' }, 3600) == 0
+
+    def test_expires(self):
+        """An Expires date in the past or an invalid date is not cached
+        """
+        assert cacheLifetime({ 'expires': 'Thu, 01 Dec 1994 16:00:00 GMT' }, 3600) == 0
+        assert cacheLifetime({ 'expires': '0' }, 3600) == 0
+
+class TestDiscoverEndpoint:
+    @mock.patch('kaku.discovery.ronkyuu.discoverEndpoint')
+    @mock.patch('kaku.discovery.requests.get')
+    def test_no_endpoint_per_url(self, get, discover, db):
+        """A page without an endpoint does not hide the endpoint of another page of the same host
+        """
+        get.return_value = response()
+        discover.return_value = (200, None, [])
+        assert discoverEndpoint(db, 'http://example.com/a')[:2] == (200, None)
+        discover.return_value = (200, 'http://example.com/webmention', [])
+        assert discoverEndpoint(db, 'http://example.com/b')[:2] == (200, 'http://example.com/webmention')
+        assert discover.call_count == 2
+        assert discoverEndpoint(db, 'http://example.com/a')[:2] == (200, None)
+        assert discover.call_count == 2
+
+    @mock.patch('kaku.discovery.requests.get')
+    def test_host_failure(self, get, db):
+        """A connection error is cached for the host and the request has a timeout
+        """
+        get.side_effect = requests.exceptions.ConnectionError()
+        assert discoverEndpoint(db, 'http://example.com/a', timeout=5)[:2] == (500, None)
+        assert get.call_args[1]['timeout'] == 5
+        assert discoverEndpoint(db, 'http://example.com/b')[:2] == (500, None)
+        assert get.call_count == 1
+
+    @mock.patch('kaku.discovery.ronkyuu.discoverEndpoint')
+    @mock.patch('kaku.discovery.requests.get')
+    def test_server_error(self, get, discover, db):
+        """A 5xx response is cached for the host but not as a result for the URL
+        """
+        get.return_value = response(503)
+        discover.return_value = (503, None, [])
+        assert discoverEndpoint(db, 'http://example.com/a')[0] == 503
+        assert db.get(db.key('kaku-discovery::url::http://example.com/a')) is None
+        assert discoverEndpoint(db, 'http://example.com/b')[0] == 503
+        assert get.call_count == 1
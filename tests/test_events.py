@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+"""
+
+import os
+import json
+import time
+
+import mock
+import redis
+
+from kaku.store import KakuRedis
+from kaku.events import addEvents, encodePayload, decodePayload, publishEvent, retryKey, deadKey, processingKey, replayDeadEvents
+from kaku.mentions import queueMention, getMentionStatus
+from kaku_events import escXML, RenderBatch
+from tests.conftest import addPost
+
+class TestEscXML:
+    def test_escape(self):
+        """Markup characters are escaped and quotes are left alone by default
+        """
+        assert escXML(u'<p class="a">b & c</p>') == u'&lt;p class="a"&gt;b &amp; c&lt;/p&gt;'
+
+    def test_escape_quotes(self):
+        """Double quotes are only escaped when asked for
+        """
+        assert escXML(u'<a href="x">\'y\'</a>', escape_quotes=True) == u'&lt;a href=&quot;x&quot;&gt;\'y\'&lt;/a&gt;'
+
+    def test_input_types(self):
+        """Byte strings are decoded as utf-8, dropping invalid bytes, and ints are converted
+        """
+        assert escXML('caf\xc3\xa9 & \xff') == u'caf\xe9 &amp; '
+        assert escXML(42) == u'42'
+        assert isinstance(escXML('abc'), unicode)
+
+class TestPublishEvents:
+    def test_bulk(self):
+        """A list of events is stored with one MSET and queued in order with one LPUSH
+        """
+        pipe = KakuRedis(keyBase='test-').pipeline()
+        keys = addEvents(pipe, 'kaku-events', [('post', 'create', { 'n': 1 }), ('post', 'update', { 'n': 2 })])
+        assert [command[0][0] for command in pipe.command_stack] == ['MSET', 'LPUSH']
+        assert list(pipe.command_stack[1][0][1:]) == ['test-kaku-events'] + keys
+        assert keys[0].startswith('test-kaku-event::post::create::')
+        payloads = dict(zip(pipe.command_stack[0][0][1::2], pipe.command_stack[0][0][2::2]))
+        assert json.loads(payloads[keys[1]])['data'] == { 'n': 2 }
+
+    def test_compress(self):
+        """Payloads longer than the threshold are stored compressed and both forms decode
+        """
+        small = { 'data': 'a' * 10 }
+        large = { 'data': 'a' * 2000 }
+        assert encodePayload(small) == json.dumps(small)
+        assert encodePayload(large).startswith('zlib:')
+        assert encodePayload(large, None) == json.dumps(large)
+        assert decodePayload(encodePayload(small)) == small
+        assert decodePayload(encodePayload(large)) == large
+
+class TestEventFailures:
+    def test_render_failure(self, site):
+        """An event whose post fails to generate is retried instead of completed
+        """
+        targetFile = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        eventKey   = publishEvent(site.db, 'kaku-events', 'post', 'update', { 'file': targetFile })
+        with mock.patch.object(site, 'postUpdate', side_effect=IOError('disk full')):
+            with mock.patch.object(site, 'indexUpdate'):
+                site.handleEvent(eventKey)
+        assert site.db.zscore(retryKey(site.db, 'kaku-events'), eventKey) is not None
+        assert site.db.ttl(eventKey) == -1
+
+    def test_render_success(self, site):
+        """An event is completed once its posts have been generated
+        """
+        targetFile = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        eventKey   = publishEvent(site.db, 'kaku-events', 'post', 'update', { 'file': targetFile })
+        with mock.patch.object(site, 'postUpdate'):
+            with mock.patch.object(site, 'indexUpdate'):
+                site.handleEvent(eventKey)
+        assert site.db.zscore(retryKey(site.db, 'kaku-events'), eventKey) is None
+        assert site.db.ttl(eventKey) > 0
+
+    def test_replay_expired(self, db):
+        """Dead events whose payload has expired are reported and not queued
+        """
+        eventKey = publishEvent(db, 'kaku-events', 'post', 'update', {})
+        db.delete(db.key('kaku-events'))
+        db.lpush(deadKey(db, 'kaku-events'), eventKey, db.key('kaku-event::post::update::gone'))
+        assert replayDeadEvents(db, 'kaku-events') == (1, [db.key('kaku-event::post::update::gone')])
+        assert db.lrange(db.key('kaku-events'), 0, -1) == [eventKey]
+        assert db.llen(deadKey(db, 'kaku-events')) == 0
+
+    def test_verify_failure(self, site):
+        """A Webmention whose verify event fails reaches the error status once dead-lettered
+        """
+        site.cfg['event_retries'] = 2
+        mentionId = queueMention(site.db, 'kaku-events', 'http://example.com/reply',
+                                 'https://bear.im/bearlog/2016/123/testing', None, False, 60)
+        eventKey  = site.db.rpop(site.db.key('kaku-events'))
+        with mock.patch.object(site, 'resolveTarget', return_value=200):
+            with mock.patch.object(site, 'verifyMention', side_effect=KeyError('name')):
+                site.handleEvent(eventKey)
+                assert getMentionStatus(site.db, mentionId)['status'] == 'queued'
+                site.handleEvent(eventKey)
+        status = getMentionStatus(site.db, mentionId)
+        assert status['status'] == 'error'
+        assert status['source'] == 'http://example.com/reply'
+
+class TestHandlePost:
+    def test_url_route(self, site):
+        """Posts given by URL are found below the base route
+        """
+        targetFile = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        open('%s.deleted' % targetFile, 'w').close()
+        batch = site.RenderBatch()
+        site.handlePost('undelete', { 'url': 'https://bear.im/bearlog/2016/123/testing' }, batch)
+        assert not os.path.exists('%s.deleted' % targetFile)
+        assert batch.posts == { targetFile: 'undelete' }
+
+class TestRenderBatch:
+    def test_ranks(self):
+        """Delete and undelete outrank create which outranks update, the latest of delete and undelete wins
+        """
+        batch = RenderBatch()
+        batch.add('a', 'update')
+        batch.add('a')
+        batch.add('b', 'delete')
+        batch.add('b', 'create')
+        batch.add('c', 'delete')
+        batch.add('c', 'undelete')
+        batch.add('d', 'undelete')
+        batch.add('d', 'delete')
+        assert batch.posts == { 'a': 'update', 'b': 'delete', 'c': 'undelete', 'd': 'delete' }
+
+    def test_create_update(self):
+        """A create and an update of the same post keep create but still record the update
+        """
+        batch = RenderBatch()
+        batch.add('a', 'update')
+        batch.add('a', 'create')
+        batch.add('b', 'create')
+        batch.add('b', 'update')
+        batch.add('c', 'create')
+        batch.add('d', 'update')
+        batch.add('d', 'delete')
+        assert batch.posts == { 'a': 'create', 'b': 'create', 'c': 'create', 'd': 'delete' }
+        assert [batch.updated(targetFile) for targetFile in 'abcd'] == [True, True, False, False]
+
+    def test_render_updated(self, site):
+        """The update's timestamp is passed on when the post is generated
+        """
+        targetFile = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        batch      = site.RenderBatch()
+        batch.add(targetFile, 'create')
+        batch.add(targetFile, 'update')
+        with mock.patch.object(site, 'postUpdate') as postUpdate:
+            site.renderBatch(batch)
+        postUpdate.assert_called_once_with(targetFile, 'create', force=False, updated=True)
+
+class TestOutboundWebmentions:
+    def test_namespaced(self, site):
+        """Sent Webmentions are recorded under the key base and removed ones are deleted
+        """
+        targetFile = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        sourceURL  = 'https://bear.im/bearlog/2016/123/testing.html'
+        href       = 'http://example.com/post'
+        key        = 'webmention::%s::%s' % (sourceURL, href)
+        resp       = mock.Mock(status_code=200, history=[])
+        with mock.patch('ronkyuu.findMentions', return_value={ 'refs': [href] }):
+            with mock.patch.object(site, 'sendOutboundWebmentions', return_value=[(200, 'http://example.com/wm', resp)]):
+                site.checkOutboundWebmentions(sourceURL, '', targetFile)
+        assert site.db.get('test-%s' % key) == '200'
+        assert not site.db.exists(key)
+        assert key in site.loadOutboundWebmentions(targetFile)
+
+        with mock.patch('ronkyuu.findMentions', return_value={ 'refs': [] }):
+            with mock.patch.object(site, 'sendOutboundWebmentions', return_value=[(200, 'http://example.com/wm', resp)]):
+                site.checkOutboundWebmentions(sourceURL, '', targetFile)
+        assert not site.db.exists('test-%s' % key)
+        assert site.loadOutboundWebmentions(targetFile) == {}
+
+class StopLoop(BaseException):
+    pass
+
+class TestEventLoop:
+    def test_error_backoff(self, site):
+        """An error in the loop is logged and the loop carries on after a delay, returning the events it holds
+        """
+        held = 'test-kaku-event::held'
+        site.registerConsumer(site.db, site.cfg.events, 'w-0', 300)
+        site.db.lpush(processingKey(site.db, site.cfg.events, 'w-0'), held)
+        claims = [redis.ConnectionError('down'), redis.ConnectionError('down'), StopLoop()]
+        with mock.patch.object(site, 'claimEvent', side_effect=claims):
+            with mock.patch('time.sleep') as sleep:
+                try:
+                    site.eventLoop('w-0', 300)
+                except StopLoop:
+                    pass
+        assert [c[0][0] for c in sleep.call_args_list] == [1, 2]
+        assert site.db.lrange(site.db.key(site.cfg.events), 0, -1) == [held]
+
+    def test_heartbeat_stops(self, site):
+        """The heartbeat of a worker stops when its event loop exits
+        """
+        with mock.patch.object(site, 'eventLoop', side_effect=StopLoop()):
+            with mock.patch.object(site, 'registerConsumer') as register:
+                try:
+                    site.runWorker('w-0', 0.3)
+                except StopLoop:
+                    pass
+                time.sleep(0.05)
+                n = register.call_count
+                time.sleep(0.25)
+                assert register.call_count == n
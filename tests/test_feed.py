@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+"""
+
+import os
+import json
+
+import pytest
+
+from xml.etree import ElementTree
+
+from tests.conftest import addPost
+
+atomNS = '{http://www.w3.org/2005/Atom}'
+
+@pytest.yield_fixture
+def feeds(site):
+    """Generate the feeds of a site with two posts, the older one updated most recently.
+    """
+    one = addPost(site, '2016', '123', 'one', '2016-05-02 10:00:00')
+    two = addPost(site, '2017', '001', 'two', '2017-01-01 10:00:00')
+    for targetFile, updated in ((one, '2017-01-05 18:00:00'), (two, '2017-01-05T16:00:00+00:00')):
+        site.postUpdate(targetFile, outbound=False)
+        with open('%s.json' % targetFile) as h:
+            data = json.load(h)
+        data['updated'] = updated
+        with open('%s.json' % targetFile, 'w') as h:
+            json.dump(data, h)
+    site.indexUpdate(force=True)
+    with open(os.path.join(site.cfg.paths.output, 'atom.xml')) as h:
+        atom = ElementTree.fromstring(h.read())
+    with open(os.path.join(site.cfg.paths.output, 'feed.json')) as h:
+        jsonFeed = json.load(h)
+    yield atom, jsonFeed
+
+class TestFeeds:
+    def test_atom(self, feeds):
+        """The Atom feed lists the newest post first and is updated by the latest post update
+        """
+        atom, jsonFeed = feeds
+        entries = atom.findall('%sentry' % atomNS)
+        assert [entry.find('%stitle' % atomNS).text for entry in entries] == ['two', 'one']
+        assert atom.find('%supdated' % atomNS).text == '2017-01-05T18:00:00+00:00'
+        assert entries[0].find('%spublished' % atomNS).text == '2017-01-01T10:00:00+00:00'
+        assert entries[1].find('%spublished' % atomNS).text == '2016-05-02T10:00:00+00:00'
+        assert entries[0].find('%slink' % atomNS).get('href') == 'https://bear.im/bearlog/2017/001/two.html'
+        assert '<strong>world</strong>' in entries[0].find('%scontent' % atomNS).text
+
+    def test_json(self, feeds):
+        """The JSON Feed has the same entries with explicit UTC offsets, dates without one are UTC
+        """
+        atom, jsonFeed = feeds
+        assert jsonFeed['version'] == 'https://jsonfeed.org/version/1'
+        assert jsonFeed['feed_url'] == 'https://bear.im/bearlog/feed.json'
+        assert [item['title'] for item in jsonFeed['items']] == ['two', 'one']
+        assert jsonFeed['items'][0]['date_modified'] == '2017-01-05T16:00:00+00:00'
+        assert jsonFeed['items'][1]['date_published'] == '2016-05-02T10:00:00+00:00'
+        assert '<strong>world</strong>' in jsonFeed['items'][0]['content_html']
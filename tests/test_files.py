@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+"""
+
+import os
+import stat
+
+import mock
+import pytest
+
+def mode(filename):
+    return stat.S_IMODE(os.stat(filename).st_mode)
+
+class TestWriteFile:
+    def test_write(self, site):
+        """A new file is written with the default mode of the umask and counted
+        """
+        filename = os.path.join(site.cfg.paths.output, 'page.html')
+        site.resetIOStats()
+        assert site.writeFile(filename, 'hello')
+        with open(filename, 'rb') as h:
+            assert h.read() == 'hello'
+        assert mode(filename) == 0o666 & ~site.fileMask
+        assert site.ioStats() == { 'written': 1, 'skipped': 0, 'bytesWritten': 5, 'bytesSkipped': 0 }
+
+    def test_unchanged(self, site):
+        """Writing the bytes a file already holds is skipped and counted
+        """
+        filename = os.path.join(site.cfg.paths.output, 'page.html')
+        site.writeFile(filename, 'hello')
+        mtime = os.path.getmtime(filename)
+        site.resetIOStats()
+        with mock.patch('tempfile.mkstemp') as mkstemp:
+            assert not site.writeFile(filename, 'hello')
+        assert not mkstemp.called
+        assert os.path.getmtime(filename) == mtime
+        assert site.ioStats() == { 'written': 0, 'skipped': 1, 'bytesWritten': 0, 'bytesSkipped': 5 }
+
+    def test_keep_mode(self, site):
+        """Replacing a file keeps its mode
+        """
+        filename = os.path.join(site.cfg.paths.output, 'page.html')
+        site.writeFile(filename, 'hello')
+        os.chmod(filename, 0o640)
+        assert site.writeFile(filename, 'hello world')
+        assert mode(filename) == 0o640
+        with open(filename, 'rb') as h:
+            assert h.read() == 'hello world'
+
+    def test_error(self, site):
+        """A failed write removes the temporary file and leaves the file as it was
+        """
+        filename = os.path.join(site.cfg.paths.output, 'page.html')
+        site.writeFile(filename, 'hello')
+        site.resetIOStats()
+        with mock.patch('os.rename', side_effect=OSError('rename failed')):
+            with pytest.raises(OSError):
+                site.writeFile(filename, 'hello world')
+        assert os.listdir(site.cfg.paths.output) == ['page.html']
+        with open(filename, 'rb') as h:
+            assert h.read() == 'hello'
+        assert site.ioStats()['written'] == 0
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+"""
+
+import os
+import json
+
+import mock
+
+from tests.conftest import addPost
+
+def manifest(site):
+    result = {}
+    for targetFile, item in site.db.hgetall(site.db.key(site.manifestKey)).items():
+        result[targetFile] = json.loads(item)
+    return result
+
+def handleQueued(site):
+    eventKey = site.db.rpop(site.db.key('kaku-events'))
+    while eventKey is not None:
+        site.handleEvent(eventKey)
+        eventKey = site.db.rpop(site.db.key('kaku-events'))
+
+class TestScanContent:
+    def test_scan(self, site):
+        """Every markdown file below the path is found along with its deleted flag
+        """
+        one = addPost(site, '2016', '123', 'one', '2016-05-02 10:00:00')
+        two = addPost(site, '2017', '001', 'two', '2017-01-01 10:00:00')
+        open('%s.deleted' % two, 'w').close()
+        open('%s.json' % one, 'w').close()
+        found = dict((targetFile, deleted) for targetFile, st, deleted in site.scanContent(site.cfg.paths.content))
+        assert found == { one: False, two: True }
+
+class TestManifestCheck:
+    def test_unchanged(self, site):
+        """A post matching its manifest entry is unchanged and not read
+        """
+        targetFile = addPost(site, '2016', '123', 'one', '2016-05-02 10:00:00')
+        st         = os.stat('%s.md' % targetFile)
+        item       = { 'mtime': st.st_mtime, 'size': st.st_size, 'deleted': False, 'hash': 'abc' }
+        with mock.patch.object(site, 'fileHash') as fileHash:
+            assert site.manifestCheck(targetFile, st, False, item) == (None, None)
+        assert not fileHash.called
+
+    def test_changed(self, site):
+        """A changed hash is an update, a changed deleted flag a delete and a new mtime alone only updates the entry
+        """
+        targetFile = addPost(site, '2016', '123', 'one', '2016-05-02 10:00:00')
+        st         = os.stat('%s.md' % targetFile)
+        item       = { 'mtime': 0, 'size': st.st_size, 'deleted': False, 'hash': 'abc' }
+        action, entry = site.manifestCheck(targetFile, st, False, item)
+        assert action == 'update'
+        assert entry['hash'] == site.fileHash('%s.md' % targetFile)
+        assert site.manifestCheck(targetFile, st, True, item)[0] == 'delete'
+        item['hash'] = entry['hash']
+        assert site.manifestCheck(targetFile, st, False, item) == (None, entry)
+        assert site.manifestCheck(targetFile, st, False, item, force=True)[0] == 'update'
+
+class TestGather:
+    def test_manifest_after_render(self, site):
+        """The manifest entry of a changed post is only saved once the post has been generated
+        """
+        targetFile = addPost(site, '2016', '123', 'one', '2016-05-02 10:00:00')
+        site.gather(site.cfg.paths.content)
+        assert manifest(site) == {}
+        handleQueued(site)
+        assert targetFile in manifest(site)
+        site.gather(site.cfg.paths.content)
+        assert site.db.llen(site.db.key('kaku-events')) == 0
+
+    def test_render_failure(self, site):
+        """A post that fails to generate is gathered again
+        """
+        targetFile = addPost(site, '2016', '123', 'one', '2016-05-02 10:00:00')
+        site.gather(site.cfg.paths.content)
+        with mock.patch.object(site, 'postUpdate', side_effect=IOError('disk full')):
+            handleQueued(site)
+        assert manifest(site) == {}
+        site.gather(site.cfg.paths.content)
+        assert site.db.llen(site.db.key('kaku-events')) == 1
+
+    def test_force(self, site):
+        """A forced gather generates every post again even though it is unchanged
+        """
+        targetFile = addPost(site, '2016', '123', 'one', '2016-05-02 10:00:00')
+        site.gather(site.cfg.paths.content)
+        handleQueued(site)
+        with mock.patch.object(site, 'saveMetadata', wraps=site.saveMetadata) as saveMetadata:
+            site.gather(site.cfg.paths.content, force=True)
+            handleQueued(site)
+        assert saveMetadata.call_count == 1
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+"""
+
+import mock
+
+def converter():
+    md = mock.Mock()
+    md.convert.side_effect = lambda content: u'<p>%s</p>' % content
+    return md
+
+class TestRenderMarkdown:
+    def test_cached(self, site):
+        """A repeat render is served from the cache
+        """
+        md = converter()
+        with mock.patch.object(site, 'getMarkdown', return_value=md):
+            assert site.renderMarkdown(u'hello') == u'<p>hello</p>'
+            assert site.renderMarkdown(u'hello') == u'<p>hello</p>'
+        assert md.convert.call_count == 1
+
+    def test_extras(self, site):
+        """Changing markdown_extras changes the cache key
+        """
+        md = converter()
+        with mock.patch.object(site, 'getMarkdown', return_value=md):
+            site.renderMarkdown(u'hello')
+            site.cfg['markdown_extras'] = ['tables']
+            site.renderMarkdown(u'hello')
+        assert md.convert.call_count == 2
+        assert len(site.mdCache) == 2
+
+    def test_eviction(self, site):
+        """The least recently used entry is evicted once markdown_cache_size is reached
+        """
+        site.cfg['markdown_cache_size'] = 2
+        md = converter()
+        with mock.patch.object(site, 'getMarkdown', return_value=md):
+            site.renderMarkdown(u'one')
+            site.renderMarkdown(u'two')
+            site.renderMarkdown(u'one')
+            site.renderMarkdown(u'three')
+            assert len(site.mdCache) == 2
+            assert md.convert.call_count == 3
+            site.renderMarkdown(u'one')
+            assert md.convert.call_count == 3
+            site.renderMarkdown(u'two')
+            assert md.convert.call_count == 4
+
+    def test_redis(self, site):
+        """With markdown_cache set to redis results are shared through Redis
+        """
+        site.cfg['markdown_cache'] = 'redis'
+        md = converter()
+        with mock.patch.object(site, 'getMarkdown', return_value=md):
+            assert site.renderMarkdown(u'héllo') == u'<p>héllo</p>'
+            keys = site.db.keys('test-kaku-markdown::*')
+            assert len(keys) == 1
+            assert site.db.ttl(keys[0]) == 604800
+            site.mdCache.clear()
+            assert site.renderMarkdown(u'héllo') == u'<p>héllo</p>'
+        assert md.convert.call_count == 1
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+"""
+
+import os
+import json
+
+from urlparse import urlparse
+
+from kaku.blobs import getBlob
+from tests.conftest import addPost
+
+sourceURL = 'http://example.com/reply'
+mf2Data   = { 'items': [], 'rels': {}, 'rel-urls': {} }
+
+def mentionRecord(source=sourceURL):
+    return { 'created': '2016-05-03T10:00:00',
+             'updated': None,
+             'mention': { 'sourceURL': source,
+                          'targetURL': 'https://bear.im/bearlog/2016/123/testing',
+                          'mf2data':   dict(mf2Data),
+                        },
+           }
+
+class TestMentionKeys:
+    def test_layout(self, site):
+        """Mentions of a post are kept in one hash per post, keyed by the source host and path
+        """
+        targetFile = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        key        = site.mentionKey(urlparse(sourceURL))
+        assert site.mentionsKey(targetFile) == 'test-kaku-mentions::%s' % targetFile
+        assert key == 'mention::example.com::/reply'
+        assert site.mentionKey(urlparse('https://example.com/reply?a=1')) == key
+
+        site.saveOurMention(targetFile, key, mentionRecord())
+        stored = json.loads(site.db.hget(site.mentionsKey(targetFile), key))
+        assert 'mf2data' not in stored['mention']
+        assert getBlob(site.db, stored['mention']['mf2']) == mf2Data
+
+class TestMigrateMentions:
+    def test_migrate(self, site):
+        """A .mentions file is moved into the store and renamed, mentions already stored are kept
+        """
+        targetFile = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        key        = site.mentionKey(urlparse(sourceURL))
+        other      = mentionRecord('http://example.org/like')
+        current    = mentionRecord()
+        current['updated'] = '2016-05-04T10:00:00'
+        site.saveOurMention(targetFile, key, current)
+        with open('%s.mentions' % targetFile, 'w') as h:
+            json.dump({ 'a': mentionRecord(), 'b': other }, h)
+
+        assert site.migrateMentions(targetFile) == 2
+        assert not os.path.exists('%s.mentions' % targetFile)
+        assert os.path.exists('%s.mentions.migrated' % targetFile)
+        mentions = site.loadOurWebmentions(targetFile)
+        assert sorted(mentions.keys()) == [key, 'mention::example.org::/like']
+        assert mentions[key]['updated'] == '2016-05-04T10:00:00'
+        assert 'mf2data' not in mentions['mention::example.org::/like']['mention']
+
+    def test_no_file(self, site):
+        targetFile = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        assert site.migrateMentions(targetFile) == 0
+
+class TestArchiveMentions:
+    def test_delete_and_restore(self, site):
+        """Deleting a post moves its mentions into a file, undeleting it returns them
+        """
+        targetFile = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        key        = site.mentionKey(urlparse(sourceURL))
+        ref        = site.mentionRef(targetFile, key)
+        site.saveOurMention(targetFile, key, mentionRecord())
+        site.db.zadd(site.db.key(site.sweepKey), { ref: 0 })
+        digest = site.loadOurMention(targetFile, key)['mention']['mf2']
+
+        with open('%s.deleted' % targetFile, 'w') as h:
+            h.write('')
+        site.postUpdate(targetFile, 'delete')
+        assert not site.db.exists(site.mentionsKey(targetFile))
+        assert site.db.zscore(site.db.key(site.sweepKey), ref) is None
+        assert getBlob(site.db, digest) is None
+        with open('%s.mentions.deleted' % targetFile, 'r') as h:
+            archived = json.load(h)
+        assert archived[key]['mention']['mf2data'] == mf2Data
+
+        os.remove('%s.deleted' % targetFile)
+        site.postUpdate(targetFile, 'update')
+        assert not os.path.exists('%s.mentions.deleted' % targetFile)
+        restored = site.loadOurMention(targetFile, key)
+        assert restored['mention']['sourceURL'] == sourceURL
+        assert getBlob(site.db, restored['mention']['mf2']) == mf2Data
+        assert site.db.zscore(site.db.key(site.sweepKey), ref) is not None
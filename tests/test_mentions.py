@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+"""
+
+from kaku.blobs import getBlob
+from kaku.mentions import checkMentionURLs, targetRoute, mentionFields, slimMention, resolveTarget, targetKey
+
+target = 'https://bear.im/bearlog/2016/123/testing.html'
+
+class TestMentionURLs:
+    def test_valid(self):
+        """A source and a target below the base route are accepted
+        """
+        assert checkMentionURLs('http://example.com/post', target, '/bearlog/') is None
+
+    def test_missing(self):
+        """Both source and target are required
+        """
+        assert checkMentionURLs(None, target, '/bearlog/') is not None
+        assert checkMentionURLs('http://example.com/post', '', '/bearlog/') is not None
+
+    def test_invalid_urls(self):
+        """Only http and https URLs are accepted and the source must differ from the target
+        """
+        assert checkMentionURLs('ftp://example.com/post', target, '/bearlog/') is not None
+        assert checkMentionURLs('example.com/post', target, '/bearlog/') is not None
+        assert checkMentionURLs(target, target, '/bearlog/') is not None
+
+    def test_target_route(self):
+        """The target must be below the base route
+        """
+        assert checkMentionURLs('http://example.com/post', 'https://bear.im/other/post.html', '/bearlog/') is not None
+
+class TestTargetRoute:
+    def test_route(self):
+        """The route is the path below the base route without the .html extension
+        """
+        assert targetRoute(target, '/bearlog/') == '2016/123/testing'
+        assert targetRoute('https://bear.im/bearlog/2016/123/testing', '/bearlog/') == '2016/123/testing'
+
+    def test_root_route(self):
+        """A base route of / only removes the leading slash
+        """
+        assert targetRoute('https://bear.im/2016/123/testing.html', '/') == '2016/123/testing'
+
+class TestMentionFields:
+    def test_entry(self):
+        """The h-card and the first h-entry's dates, name and summary are extracted
+        """
+        mf2Data = { 'items': [ { 'type':       ['h-card'],
+                                 'properties': { 'name': ['Ex'], 'url': ['http://example.com'] } },
+                               { 'type':       ['h-entry'],
+                                 'properties': { 'published': ['2016-05-03T10:00:00Z'],
+                                                 'name':      ['A reply'],
+                                                 'content':   [{ 'value': 'some\n  text', 'html': '<p>some text</p>' }] } } ] }
+        fields = mentionFields(mf2Data)
+        assert fields['hcard'] == { 'name': ['Ex'], 'url': ['http://example.com'] }
+        assert fields['published'] == '2016-05-03T10:00:00Z'
+        assert fields['updated'] is None
+        assert fields['name'] == 'A reply'
+        assert fields['summary'] == 'some text'
+
+    def test_summary_length(self):
+        """Long content is cut to the summary length
+        """
+        mf2Data = { 'items': [ { 'type': ['h-entry'], 'properties': { 'content': ['word ' * 100] } } ] }
+        assert mentionFields(mf2Data, 20)['summary'] == u'word word word word\u2026'
+        assert mentionFields({})['summary'] is None
+
+class TestSlimMention:
+    def test_slim(self, db):
+        """The mf2 data of a mention is moved to the blob store and its display fields kept
+        """
+        mf2Data = { 'items': [ { 'type': ['h-entry'], 'properties': { 'name': ['A reply'] } } ] }
+        mention = slimMention(db, { 'sourceURL': 'http://example.com/reply', 'mf2data': mf2Data }, 'ref')
+        assert 'mf2data' not in mention
+        assert getBlob(db, mention['mf2']) == mf2Data
+        assert mention['name'] == 'A reply'
+        assert slimMention(db, dict(mention), 'ref') == mention
+
+class TestResolveTarget:
+    def test_post(self, db, tmpdir):
+        """An existing post resolves to 200 and is cached for the ttl, a deleted one to 410
+        """
+        tmpdir.mkdir('2016').mkdir('123').join('testing.md').write('Title: testing')
+        assert resolveTarget(db, target, '/bearlog/', str(tmpdir), 3600) == 200
+        assert 3500 < db.ttl(targetKey(db, '2016/123/testing')) <= 3600
+        tmpdir.join('2016', '123', 'testing.deleted').write('')
+        db.delete(targetKey(db, '2016/123/testing'))
+        assert resolveTarget(db, target, '/bearlog/', str(tmpdir), 3600) == 410
+
+    def test_missing(self, db, tmpdir):
+        """A missing post is only cached briefly
+        """
+        assert resolveTarget(db, target, '/bearlog/', str(tmpdir), 3600) == 404
+        assert 0 < db.ttl(targetKey(db, '2016/123/testing')) <= 60
+
+    def test_outside(self, db, tmpdir):
+        """Targets outside of the base route or the content path are not cached
+        """
+        assert resolveTarget(db, 'https://bear.im/other/2016/123/testing', '/bearlog/', str(tmpdir)) == 404
+        assert resolveTarget(db, 'https://bear.im/bearlog/../../etc/passwd', '/bearlog/', str(tmpdir)) == 404
+        assert db.keys('*') == []
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+"""
+
+from kaku.store import KakuRedis
+
+class TestStore:
+    def test_key(self):
+        """Keys are namespaced with the key base by the client and its pipelines
+        """
+        db = KakuRedis.from_url('redis://127.0.0.1:6379/0', keyBase='test-')
+        assert db.key('kaku-events') == 'test-kaku-events'
+        assert db.pipeline().key('kaku-events') == 'test-kaku-events'
+        assert KakuRedis().key('kaku-events') == 'kaku-events'
+
+    def test_round_trips(self):
+        """Pipelines without any commands do not count as a round trip
+        """
+        db = KakuRedis()
+        db.resetRoundTrips()
+        db.pipeline().execute()
+        assert db.roundTrips() == 0
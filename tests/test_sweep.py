@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+"""
+
+import json
+import time
+import datetime
+
+import mock
+import requests
+
+from tests.conftest import addPost
+
+sourceURL = 'http://example.com/reply'
+
+def addMention(site, targetFile):
+    key    = 'mention::example.com::/reply'
+    record = { 'created': '2016-05-03T10:00:00',
+               'updated': None,
+               'mention': { 'sourceURL': sourceURL, 'targetURL': 'https://bear.im/bearlog/2016/123/testing' },
+             }
+    site.saveOurMention(targetFile, key, record)
+    member = json.dumps([targetFile, key])
+    site.db.zadd(site.db.key(site.sweepKey), { member: 0 })
+    return key, member
+
+class TestMentionCheckInterval:
+    def test_interval(self, site):
+        """The interval is a quarter of the mention's age within the configured bounds
+        """
+        now = site.getTimestamp().replace(tzinfo=None)
+        assert site.mentionCheckInterval({}) == 3600
+        assert site.mentionCheckInterval({ 'created': (now - datetime.timedelta(days=8)).isoformat() }) == 172800
+        assert site.mentionCheckInterval({ 'created': (now - datetime.timedelta(days=60)).isoformat() }) == 604800
+        assert site.mentionCheckInterval({ 'created': now.isoformat() }) == 3600
+
+    def test_invalid_date(self, site):
+        """A malformed created date falls back to the minimum interval
+        """
+        assert site.mentionCheckInterval({ 'created': 'not a date' }) == 3600
+        assert site.mentionCheckInterval({ 'created': '99999999999-01-01' }) == 3600
+
+class TestCheckMention:
+    def test_timeout(self, site):
+        """A source that does not respond in time is not gone
+        """
+        record = { 'mention': { 'sourceURL': sourceURL } }
+        with mock.patch('requests.get', side_effect=requests.exceptions.Timeout()) as get:
+            assert site.checkMention(record) is False
+        assert get.call_args[1]['timeout'] == 10
+
+    def test_gone(self, site):
+        """A 410 response means the source is gone
+        """
+        record = { 'mention': { 'sourceURL': sourceURL } }
+        with mock.patch('requests.get', return_value=mock.Mock(status_code=410)):
+            assert site.checkMention(record) is True
+
+class TestSweepMentions:
+    def test_alive(self, site):
+        """A mention that still exists is rescheduled with its new validators, the post lock is not held during the fetch
+        """
+        targetFile  = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        key, member = addMention(site, targetFile)
+
+        def check(record):
+            lock = site.workLock(targetFile)
+            assert lock.acquire(blocking=False)
+            lock.release()
+            record['etag'] = 'abc'
+            return False
+
+        with mock.patch.object(site, 'checkMention', side_effect=check):
+            assert site.sweepMentions() == 1
+        assert site.loadOurMention(targetFile, key)['etag'] == 'abc'
+        assert site.db.zscore(site.db.key(site.sweepKey), member) > time.time()
+
+    def test_gone(self, site):
+        """A mention whose source is gone is removed and the post generated again
+        """
+        targetFile  = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        key, member = addMention(site, targetFile)
+        with mock.patch.object(site, 'checkMention', return_value=True):
+            with mock.patch.object(site, 'postUpdate') as postUpdate:
+                assert site.sweepMentions() == 1
+        postUpdate.assert_called_once_with(targetFile)
+        assert site.loadOurMention(targetFile, key) is None
+        assert site.db.zscore(site.db.key(site.sweepKey), member) is None
+
+    def test_removed_during_check(self, site):
+        """A mention removed while its source was fetched is not saved again
+        """
+        targetFile  = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        key, member = addMention(site, targetFile)
+
+        def check(record):
+            site.deleteOurMention(targetFile, key)
+            record['etag'] = 'abc'
+            return False
+
+        with mock.patch.object(site, 'checkMention', side_effect=check):
+            assert site.sweepMentions() == 1
+        assert site.loadOurMention(targetFile, key) is None
+        assert site.db.zscore(site.db.key(site.sweepKey), member) is None
+
+    def test_claimed(self, site):
+        """A mention claimed by another sweeper between the range and the zrem is skipped
+        """
+        targetFile  = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        key, member = addMention(site, targetFile)
+        with mock.patch.object(site.db, 'zrem', return_value=0):
+            with mock.patch.object(site, 'checkMention') as checkMention:
+                assert site.sweepMentions() == 0
+        assert not checkMention.called
+
+class TestRenderFingerprint:
+    def test_validators(self, site):
+        """Only the mention details passed to the templates change the render fingerprint
+        """
+        targetFile = addPost(site, '2016', '123', 'testing', '2016-05-02 10:00:00')
+        mentions   = { 'mention::example.com::/reply': { 'created': None,
+                                                         'mention': { 'sourceURL': sourceURL, 'name': 'A reply' } } }
+        fingerprint = site.renderFingerprint(targetFile, mentions)
+        mentions['mention::example.com::/reply']['etag']         = 'abc'
+        mentions['mention::example.com::/reply']['lastModified'] = 'Tue, 03 May 2016 10:00:00 GMT'
+        assert site.renderFingerprint(targetFile, mentions) == fingerprint
+        mentions['mention::example.com::/reply']['mention']['name'] = 'An edited reply'
+        assert site.renderFingerprint(targetFile, mentions) != fingerprint
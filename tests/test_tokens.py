@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: (c) 2016 by Mike Taylor
+:license: CC0 1.0 Universal, see LICENSE for more details.
+"""
+
+import mock
+
+from kaku.tokens import createToken, verifyToken, parseLegacyToken, RevokedTokens
+
+secret = 'test-secret'
+
+class TestTokens:
+    def test_roundtrip(self):
+        """A signed token carries the details of the grant
+        """
+        claims = verifyToken(secret, createToken(secret, 'https://my-site.com/', 'https://client.example/', 'post', 60))
+        assert claims['me'] == 'https://my-site.com/'
+        assert claims['client_id'] == 'https://client.example/'
+        assert claims['scope'] == 'post'
+
+    def test_invalid(self):
+        """Tokens with a bad signature, a different secret or that have expired are not valid
+        """
+        token = createToken(secret, 'https://bear.im/', 'https://client.example/', 'post', 60)
+        assert verifyToken(secret, token[:-2] + 'xx') is None
+        assert verifyToken('other-secret', token) is None
+        assert verifyToken(secret, createToken(secret, 'https://bear.im/', 'https://client.example/', 'post', -1)) is None
+        assert verifyToken(secret, 'not a token') is None
+
+    def test_non_ascii(self):
+        """Tokens with non-ASCII characters are not valid
+        """
+        token = createToken(secret, 'https://bear.im/', 'https://client.example/', 'post', 60)
+        assert verifyToken(secret, unicode(token)) is not None
+        assert verifyToken(secret, token[:-2] + u'\xe9\xe9') is None
+        assert verifyToken(secret, token[:-2] + '\xc3\xa9') is None
+
+    def test_legacy(self):
+        """Legacy token keys are parsed even when the URLs contain hyphens
+        """
+        assert parseLegacyToken('app-https://my-site.com/-https://quill-app.io/-post create') == \
+            ('https://my-site.com/', 'https://quill-app.io/', 'post create')
+        assert parseLegacyToken('garbage') == (None, None, None)
+
+    def test_revoked(self):
+        """The revoked token set is only read from Redis when the local copy expires
+        """
+        db     = mock.Mock()
+        claims = verifyToken(secret, createToken(secret, 'https://bear.im/', 'https://client.example/', 'post', 60))
+        db.zrangebyscore.return_value = [claims['jti']]
+        revoked = RevokedTokens(db, ttl=60)
+        assert revoked.isRevoked(claims)
+        assert revoked.isRevoked({ 'jti': 'other' }) is False
+        assert db.zrangebyscore.call_count == 1